@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+"""
+           Bulk decoding benchmark
+
+ Compares decode_capture() with the streaming decoder on a synthetic
+ capture and checks that both give the same result
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import numpy as np
+from smartport import encode_frame
+from smartport_bulk import decode_capture, decode_stream, COLUMNS
+
+SENSORS = ((0x1b, 0x0300), (0x1b, 0x0210), (0x22, 0x0b50), (0x22, 0x0b60),
+           (0x83, 0x0800), (0x83, 0x0820), (0x83, 0x0830), (0x98, 0xf101))
+
+
+def make_capture(frames, chunk_size, seed):
+    rng = random.Random(seed)
+    data = bytearray()
+    for _ in range(frames):
+        sensor_id, data_id = rng.choice(SENSORS)
+        data += encode_frame(sensor_id, data_id, rng.getrandbits(32))
+        data += bytes((0x7E, 0xA1))
+    offsets = list(range(0, len(data), chunk_size))
+    chunks = [bytes(data[offset:offset + chunk_size]) for offset in offsets]
+    times = [i * 0.01 for i in range(len(chunks))]
+    return bytes(data), offsets, chunks, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk decoding benchmark')
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--chunk', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    data, offsets, chunks, times = make_capture(args.frames, args.chunk, args.seed)
+    start = time.perf_counter()
+    stream = decode_stream(chunks, times)
+    time_stream = time.perf_counter() - start
+    start = time.perf_counter()
+    bulk = decode_capture(data, offsets, times)
+    time_bulk = time.perf_counter() - start
+    for key in COLUMNS:
+        if not np.array_equal(stream[key], bulk[key], equal_nan=True):
+            sys.exit('Mismatch in column ' + key)
+    print('bytes {} frames {} rows {}'.format(len(data), args.frames, bulk['value'].size))
+    print('stream {:.3f} s {:.0f} frames/s'.format(time_stream, args.frames / time_stream))
+    print('bulk   {:.3f} s {:.0f} frames/s'.format(time_bulk, args.frames / time_bulk))
+    print('speedup {:.1f}x'.format(time_stream / time_bulk))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+"""
+           Config store benchmark
+
+ Time spent by the caller per config edit with hundreds of monitors,
+ rewriting the whole file on each edit like kivy's JsonStore against the
+ debounced ConfigStore, and the number of file writes of each
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from config_store import ConfigStore
+
+
+class RewriteStore():
+
+    # Writes the whole file on every assignment, as JsonStore does
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self.writes = 0
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        with open(self.path, 'w') as file:
+            json.dump(self.data, file)
+        self.writes += 1
+
+    def flush(self):
+        pass
+
+
+def make_config(monitors, seed):
+    rng = random.Random(seed)
+    config = {'settings': {'devices': [{'name': 'HC-05', 'address': '00:11:22:33:44:55', 'type': 'classic'}]}}
+    for i in range(monitors):
+        monitor = {'type': 'monitor', 'name': 'Model {}'.format(i)}
+        for cont in range(1, 7):
+            monitor['sensor' + str(cont)] = {
+                'name': 'Sensor', 'sensor_id': 0x1b, 'data_id': rng.choice((0x0300, 0x0210, 0x0b50)),
+                'index': 0, 'unit': 'v', 'device': '00:11:22:33:44:55', 'multiplier': 1.0,
+                'alarm': False, 'alarm_condition': 'lower', 'alarm_interval': 0, 'alarm_value': 0,
+                'alarm_hysteresis': 0.0, 'alarm_debounce': 0.0, 'alarm_text': '', 'callout': 0}
+        config['monitor{}'.format(i)] = monitor
+    return config
+
+
+def run(store, config, edits, interval, seed):
+    # per edit latency percentiles in us, edits every interval seconds
+    rng = random.Random(seed)
+    for key, value in config.items():
+        store.data[key] = value
+    keys = [key for key in config if key != 'settings']
+    latencies = []
+    for i in range(edits):
+        key = rng.choice(keys)
+        config[key]['sensor1']['multiplier'] = rng.random()
+        start = time.perf_counter()
+        store[key] = config[key]
+        latencies.append((time.perf_counter() - start) * 1e6)
+        if interval:
+            time.sleep(interval)
+    start = time.perf_counter()
+    store.flush()
+    flush = time.perf_counter() - start
+    latencies.sort()
+    return {'p50': latencies[len(latencies) // 2],
+            'p99': latencies[len(latencies) * 99 // 100],
+            'max': latencies[-1],
+            'writes': store.writes,
+            'flush': flush * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Config store benchmark')
+    parser.add_argument('--monitors', type=int, default=300)
+    parser.add_argument('--edits', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.01, help='seconds between edits')
+    parser.add_argument('--delay', type=float, default=1.0, help='ConfigStore write delay')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'smartportbt.json')
+        results = [('rewrite', run(RewriteStore(path), make_config(args.monitors, 1), args.edits,
+                                   args.interval, 2))]
+        os.remove(path)
+        store = ConfigStore(path, args.delay)
+        results.append(('config store', run(store, make_config(args.monitors, 1), args.edits,
+                                            args.interval, 2)))
+        size = os.path.getsize(path)
+        with open(path) as file:
+            reloaded = json.load(file) == store.data
+    print('{:<14}{:>10}{:>10}{:>10}{:>8}{:>10}'.format('edit', 'p50 us', 'p99 us', 'max us', 'writes',
+                                                      'flush ms'))
+    for name, result in results:
+        print('{:<14}{:>10.0f}{:>10.0f}{:>10.0f}{:>8}{:>10.1f}'.format(
+            name, result['p50'], result['p99'], result['max'], result['writes'], result['flush']))
+    print('{:<14}{:>10}'.format('file bytes', size))
+    print('{:<14}{:>10}'.format('reloaded', str(reloaded)))
+
+
+if __name__ == '__main__':
+    main()
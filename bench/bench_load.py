@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+"""
+           Load test
+
+ Drives the decode path from the simulated sensor hub at increasing frame
+ rates and reports where it stops keeping up. With --connections each
+ simulated link has its own thread, decoder and store like the app's
+ connections, rates are per link
+
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import telemetry
+from simulator import SimulatedHub
+from smartport import SmartportDecoder
+
+
+def drive(hub, decoder, store, start, seconds):
+    while time.monotonic() - start < seconds:
+        telemetry.decode_buffer(decoder, hub.read(256), store)
+
+
+def run(rate, seconds, noise, drop, burst, connections=1):
+    links = []
+    for i in range(connections):
+        hub = SimulatedHub(rate=rate, noise=noise, drop=drop, burst=burst, seed=1 + i)
+        hub.connect(None, None)
+        links.append((hub, SmartportDecoder(), telemetry.get_store('hub' + str(i))))
+    start = time.monotonic()
+    cpu = time.process_time()
+    threads = [threading.Thread(target=drive, args=link + (start, seconds)) for link in links]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    return {'rate': rate,
+            'sent': sum(hub.frames for hub, _, _ in links) / elapsed / connections,
+            'decoded': sum(decoder.frames for _, decoder, _ in links) / elapsed / connections,
+            'crc_errors': sum(decoder.crc_errors for _, decoder, _ in links),
+            'resyncs': sum(decoder.resyncs for _, decoder, _ in links),
+            'cpu': (time.process_time() - cpu) / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode path load test')
+    parser.add_argument('--rates', default='100,1000,10000,50000,0',
+                        help='frames per second, 0 for unlimited')
+    parser.add_argument('--seconds', type=float, default=2)
+    parser.add_argument('--noise', type=float, default=0.0)
+    parser.add_argument('--drop', type=float, default=0.0)
+    parser.add_argument('--burst', type=float, default=1)
+    parser.add_argument('--connections', type=int, default=1, help='simultaneous simulated links')
+    args = parser.parse_args()
+    print('{:>10}{:>12}{:>12}{:>12}{:>10}{:>8}'.format(
+        'rate', 'sent/s', 'decoded/s', 'crc errors', 'resyncs', 'cpu'))
+    for rate in args.rates.split(','):
+        result = run(int(rate), args.seconds, args.noise, args.drop, args.burst, args.connections)
+        print('{:>10}{:>12.0f}{:>12.0f}{:>12}{:>10}{:>8.0%}'.format(
+            result['rate'] or 'max', result['sent'], result['decoded'],
+            result['crc_errors'], result['resyncs'], result['cpu']))
+
+
+if __name__ == '__main__':
+    main()
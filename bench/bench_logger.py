@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+"""
+           Telemetry logger benchmark
+
+ Latency of TelemetryStore.add with and without the background logger,
+ and the logger's write throughput, drops and file sizes
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from telemetry import TelemetryStore
+from telemetry_log import TelemetryLogger, read_log
+
+# physical id, data_id
+SENSORS = ((0x1b, 0x0300), (0x1b, 0x0210), (0x22, 0x0b50), (0x22, 0x0b60), (0x83, 0x0830),
+           (0x98, 0xf101))
+
+
+def make_frames(count, seed):
+    rng = random.Random(seed)
+    return [(sensor_id, 0x10, data_id, rng.getrandbits(32))
+            for sensor_id, data_id in (rng.choice(SENSORS) for _ in range(count))]
+
+
+def latency(store, frames, rate):
+    # per frame latency percentiles in ns, paced like a link when rate is
+    # set so the writer keeps up
+    clock = time.perf_counter_ns
+    latencies = []
+    start = time.monotonic()
+    for i, frame in enumerate(frames):
+        if rate:
+            due = start + i / rate - time.monotonic()
+            if due > 0:
+                time.sleep(due)
+        t = clock()
+        store.add(frame)
+        latencies.append(clock() - t)
+    elapsed = time.monotonic() - start
+    latencies.sort()
+    return {'throughput': len(frames) / elapsed,
+            'p50': latencies[len(latencies) // 2],
+            'p99': latencies[len(latencies) * 99 // 100],
+            'max': latencies[-1]}
+
+
+def run(frames, format, rate, max_size, directory):
+    frames = make_frames(frames, 1)
+    results = [('no logger', latency(TelemetryStore(), frames, rate))]
+    store = TelemetryStore()
+    logger = TelemetryLogger(os.path.join(directory, 'bench'), format, max_size=max_size)
+    logger.start()
+    store.logger = logger
+    results.append(('logger ' + format, latency(store, frames, rate)))
+    start = time.monotonic()
+    logger.stop()
+    flush = time.monotonic() - start
+    records = sum(1 for path in logger.paths for _ in read_log(path))
+    size = sum(os.path.getsize(path) for path in logger.paths)
+    return results, {'written': logger.written, 'dropped': logger.dropped, 'read back': records,
+                     'files': len(logger.paths), 'bytes': size, 'final flush s': round(flush, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Telemetry logger benchmark')
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--format', default='binary', choices=('binary', 'csv'))
+    parser.add_argument('--rate', type=int, default=0, help='frames per second, 0 unpaced')
+    parser.add_argument('--max-size', type=int, default=1024 * 1024, help='bytes per log file')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        results, stats = run(args.frames, args.format, args.rate, args.max_size, directory)
+    print('{:<16}{:>14}{:>10}{:>10}{:>10}'.format('add', 'frames/s', 'p50 ns', 'p99 ns', 'max ns'))
+    for name, result in results:
+        print('{:<16}{:>14.0f}{:>10}{:>10}{:>10}'.format(
+            name, result['throughput'], result['p50'], result['p99'], result['max']))
+    for key, value in stats.items():
+        print('{:<16}{:>14}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+"""
+           Series benchmark
+
+ Time per sample appended to a SeriesBuffer, and its rolling window stats
+ checked against a brute force min, max and mean of the retained samples
+ in the window, at rates that overflow the ring before the window ends
+
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from series import SeriesBuffer
+
+
+def stream(kind, samples, rate, seed):
+    # (timestamp, value) pairs, jittered timestamps
+    rng = random.Random(seed)
+    timestamp = 0.0
+    for i in range(samples):
+        timestamp += rng.uniform(0.5, 1.5) / rate
+        if kind == 'sine':
+            value = 20 + 10 * math.sin(timestamp / 7)
+        elif kind == 'steps':
+            value = float(rng.randrange(4))
+        else:
+            value = rng.uniform(-100, 100)
+        yield timestamp, value
+
+
+def brute_force(series, seconds):
+    # (min, max, mean) of the samples in the ring within seconds
+    count = min(series.count, series.capacity)
+    last = series.time(series.count - 1)
+    values = [series.value(position) for position in range(series.count - count, series.count)
+              if series.time(position) >= last - seconds]
+    if not values:
+        return None
+    return min(values), max(values), sum(values) / len(values)
+
+
+def check(kind, samples, rate, capacity, seed):
+    series = SeriesBuffer(capacity)
+    mismatches = 0
+    for timestamp, value in stream(kind, samples, rate, seed):
+        series.append(timestamp, value)
+        for seconds in series.windows:
+            expected = brute_force(series, seconds)
+            result = series.stats(seconds)
+            if expected is None or result is None:
+                mismatches += expected != result
+            elif any(abs(a - b) > 1e-6 * max(1.0, abs(b)) for a, b in zip(result, expected)):
+                mismatches += 1
+    return mismatches
+
+
+def timing(samples, rate, capacity):
+    series = SeriesBuffer(capacity)
+    points = list(stream('random', samples, rate, 1))
+    start = time.perf_counter()
+    for timestamp, value in points:
+        series.append(timestamp, value)
+    return (time.perf_counter() - start) / samples * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Series benchmark')
+    parser.add_argument('--samples', type=int, default=3000, help='samples checked per case')
+    parser.add_argument('--capacity', type=int, default=1024)
+    args = parser.parse_args()
+    print('{:<10}{:>8}{:>12}'.format('stream', 'Hz', 'mismatches'))
+    failed = 0
+    for kind in ('sine', 'steps', 'random'):
+        for rate in (5, 20, 100):
+            mismatches = check(kind, args.samples, rate, args.capacity, rate)
+            failed += mismatches
+            print('{:<10}{:>8}{:>12}'.format(kind, rate, mismatches))
+    print('{:<10}{:>8}{:>12.0f}'.format('append', 'ns', timing(200000, 100, args.capacity)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+"""
+           Telemetry server benchmark
+
+ Publishes a synthetic stream through TelemetryStore to loopback clients:
+ fast TCP clients, a filtered one, a WebSocket one and a slow reader.
+ Reports the cost on TelemetryStore.add and what each client received
+
+"""
+
+import argparse
+import base64
+import os
+import socket
+import sys
+import threading
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from telemetry import TelemetryStore
+from server import TelemetryServer
+from bench_logger import make_frames, latency
+
+
+class Client(threading.Thread):
+
+    # Loopback client counting the frames it receives, delay seconds are
+    # slept between reads to simulate a slow consumer
+
+    def __init__(self, name, port, websocket=False, filter=None, delay=0.0):
+        super().__init__(name=name, daemon=True)
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096 if delay else 1 << 20)
+        if websocket:
+            key = base64.b64encode(os.urandom(16))
+            self.socket.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+                                b'Connection: Upgrade\r\nSec-WebSocket-Key: ' + key +
+                                b'\r\nSec-WebSocket-Version: 13\r\n\r\n')
+            response = b''
+            while b'\r\n\r\n' not in response:
+                response += self.socket.recv(1024)
+        if filter:
+            if websocket:
+                payload = filter.encode()
+                mask = os.urandom(4)
+                self.socket.sendall(bytes((0x81, 0x80 | len(payload))) + mask +
+                                    bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+            else:
+                self.socket.sendall(filter.encode() + b'\n')
+        self.delay = delay
+        self.received = 0
+        self.closed = False
+
+    def run(self):
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                self.closed = True
+                return
+            # frames end with a newline on tcp and websocket alike
+            self.received += data.count(b'\n')
+            if self.delay:
+                time.sleep(self.delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Telemetry server benchmark')
+    parser.add_argument('--frames', type=int, default=50000)
+    parser.add_argument('--rate', type=int, default=2000, help='frames per second, 0 unpaced')
+    parser.add_argument('--clients', type=int, default=4, help='fast tcp clients')
+    parser.add_argument('--queue-size', type=int, default=256)
+    parser.add_argument('--policy', default='downsample', choices=('downsample', 'drop'))
+    args = parser.parse_args()
+    frames = make_frames(args.frames, 1)
+    results = [('no server', latency(TelemetryStore(), frames, args.rate))]
+    server = TelemetryServer('127.0.0.1', 0, 0, args.queue_size, args.policy)
+    server.start()
+    clients = [Client('tcp {}'.format(i), server.port) for i in range(args.clients)]
+    clients.append(Client('filtered', server.port, filter='{"data_id": ["0x0300"]}'))
+    clients.append(Client('websocket', server.ws_port, websocket=True))
+    clients.append(Client('slow', server.port, delay=0.05))
+    for client in clients:
+        client.start()
+    time.sleep(0.2)
+    store = TelemetryStore()
+    store.publisher = server
+    results.append(('server', latency(store, frames, args.rate)))
+    time.sleep(1)
+    print('{:<16}{:>14}{:>10}{:>10}{:>10}'.format('add', 'frames/s', 'p50 ns', 'p99 ns', 'max ns'))
+    for name, result in results:
+        print('{:<16}{:>14.0f}{:>10}{:>10}{:>10}'.format(
+            name, result['throughput'], result['p50'], result['p99'], result['max']))
+    print('{:<16}{:>14}{:>10}'.format('client', 'received', 'closed'))
+    for client in clients:
+        print('{:<16}{:>14}{:>10}'.format(client.name, client.received, str(client.closed)))
+    print('{:<16}{:>14}'.format('published', server.published))
+    print('{:<16}{:>14}'.format('dropped', server.dropped))
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
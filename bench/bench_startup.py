@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+"""
+           Startup benchmark
+
+ Runs the app until its first frame several times and reports the time
+ to each startup stage. Needs a display, xvfb-run works on headless Linux
+
+ python3 bench/bench_startup.py --runs 10 --output startup.json
+ python3 bench/bench_startup.py --compare startup.json
+
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+
+def run_once(timeout):
+    # {stage: ms} of one run, stages are in order of appearance
+    environment = dict(os.environ, SMARTPORT_STARTUP_TIMINGS='exit', KIVY_NO_CONSOLELOG='1',
+                       KIVY_NO_ARGS='1')
+    result = subprocess.run([sys.executable, 'main.py'], cwd=SRC, env=environment,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    stages = {}
+    for line in result.stdout.decode(errors='replace').splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == 'startup':
+            stages[fields[1]] = float(fields[2])
+    if 'first_frame' not in stages:
+        sys.exit('App didn\'t reach its first frame:\n' + result.stderr.decode(errors='replace')[-2000:])
+    return stages
+
+
+def run(runs, timeout):
+    samples = {}
+    for _ in range(runs):
+        for stage, value in run_once(timeout).items():
+            samples.setdefault(stage, []).append(value)
+    return {stage: {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+            for stage, values in samples.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds per run')
+    parser.add_argument('--output', help='save the results as json')
+    parser.add_argument('--compare', help='json results of a previous run')
+    args = parser.parse_args()
+    results = run(args.runs, args.timeout)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print('{:<14}{:>10}{:>10}{:>10}{:>12}'.format('stage ms', 'median', 'min', 'max',
+                                                 'baseline' if baseline else ''))
+    for stage, result in results.items():
+        line = '{:<14}{:>10.1f}{:>10.1f}{:>10.1f}'.format(stage, result['median'], result['min'],
+                                                         result['max'])
+        if stage in baseline:
+            line += '{:>12.1f}{:>+9.1f}%'.format(
+                baseline[stage]['median'],
+                (result['median'] / baseline[stage]['median'] - 1) * 100 if baseline[stage]['median'] else 0)
+        print(line)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+
+"""
+           Telemetry hot path benchmark
+
+ Runs without Kivy on a synthetic SmartPort stream. Reports throughput,
+ per item latency percentiles and the bytes allocated per item, the
+ traced peak of each call, for each stage and saves the results as json
+
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import telemetry
+from smartport import check_crc, encode_frame, get_sensor_data, SmartportDecoder, FRAME_STRUCT
+
+# physical id, data_id, value generator
+SENSORS = (
+    (0x1b, 0x0300, lambda rng: rng.randrange(16) & 0xE | rng.randrange(1700, 2100) << 8 | rng.randrange(1700, 2100) << 20),
+    (0x1b, 0x0210, lambda rng: rng.randrange(2000, 2520)),
+    (0x22, 0x0200, lambda rng: rng.randrange(0, 1500)),
+    (0x22, 0x0b50, lambda rng: rng.randrange(2000, 2520) | rng.randrange(0, 15000) << 16),
+    (0x22, 0x0b60, lambda rng: rng.randrange(0, 500) | rng.randrange(0, 5000) << 16),
+    (0x83, 0x0800, lambda rng: rng.getrandbits(32)),
+    (0x83, 0x0820, lambda rng: rng.randrange(0, 50000)),
+    (0x83, 0x0830, lambda rng: rng.randrange(0, 100000)),
+    (0x83, 0x0840, lambda rng: rng.randrange(0, 36000)),
+    (0x98, 0xf101, lambda rng: rng.randrange(20, 110)),
+    (0x98, 0x0100, lambda rng: rng.randrange(0, 30000)),
+)
+MONITOR = {
+    'sensor1': {'index': 2, 'sensor_id': 0x1b, 'data_id': 0x0300, 'value': 'sum', 'multiplier': 1.0},
+    'sensor2': {'index': 2, 'sensor_id': 0x1b, 'data_id': 0x0300, 'value': 'delta', 'multiplier': 1.0},
+    'sensor3': {'index': 0, 'sensor_id': 0x22, 'data_id': 0x0b50, 'value': '', 'multiplier': 1.0},
+    'sensor4': {'index': 1, 'sensor_id': 0x22, 'data_id': 0x0b50, 'value': '', 'multiplier': 1.0},
+    'sensor5': {'index': 0, 'sensor_id': 0x83, 'data_id': 0x0830, 'value': '', 'multiplier': 1.852},
+    'sensor6': {'index': 0, 'sensor_id': 0x98, 'data_id': 0xf101, 'value': '', 'multiplier': 1.0},
+}
+for sensor in MONITOR.values():
+    sensor.update({'name': '', 'unit': '', 'alarm': False, 'alarm_condition': 'lower',
+                   'alarm_value': 0, 'alarm_interval': 0, 'alarm_text': ''})
+
+
+def make_stream(frames, corrupt, seed):
+    # returns the stuffed byte stream and the unstuffed packets, a share of
+    # them with a corrupted CRC
+    rng = random.Random(seed)
+    data = bytearray()
+    packets = []
+    for _ in range(frames):
+        sensor_id, data_id, generator = rng.choice(SENSORS)
+        value = generator(rng)
+        frame = encode_frame(sensor_id, data_id, value)
+        if rng.random() < corrupt:
+            frame = frame[:-1] + bytes(((frame[-1] + 1) & 0x7F,))
+        packet = bytearray(frame.replace(b'\x7d\x5e', b'\x7e').replace(b'\x7d\x5d', b'\x7d'))
+        packets.append(packet)
+        data += frame
+        # poll of an absent sensor
+        data += bytes((0x7E, 0xA1))
+    return bytes(data), packets
+
+
+def measure(name, function, items, repeat):
+    # throughput over the whole batch, latency on each call
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            function(item)
+    elapsed = time.perf_counter() - start
+    count = len(items) * repeat
+    latencies = []
+    clock = time.perf_counter_ns
+    for item in items:
+        t = clock()
+        function(item)
+        latencies.append(clock() - t)
+    latencies.sort()
+    # memory allocated during each call, freed or not
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    allocated = 0
+    for item in items:
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        function(item)
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    gc.enable()
+    return {'stage': name,
+            'items': count,
+            'throughput': count / elapsed,
+            'latency_ns': {'p50': latencies[len(latencies) // 2],
+                           'p90': latencies[len(latencies) * 9 // 10],
+                           'p99': latencies[len(latencies) * 99 // 100],
+                           'max': latencies[-1]},
+            'alloc_bytes_per_item': allocated / len(items)}
+
+
+def run(frames, corrupt, chunk, seed, repeat):
+    data, packets = make_stream(frames, corrupt, seed)
+    frame_tuples = [FRAME_STRUCT.unpack_from(packet, 1) for packet in packets if check_crc(packet)]
+    data_ids = [frame[2] for frame in frame_tuples]
+    chunks = [data[i:i + chunk] for i in range(0, len(data), chunk)]
+    results = []
+    results.append(measure('check_crc', check_crc, packets, repeat))
+    results.append(measure('get_sensor_data', get_sensor_data, data_ids, repeat))
+    telemetry.telemetry.clear()
+    results.append(measure('add_telemetry', telemetry.add_telemetry, frame_tuples, repeat))
+    history = telemetry.TelemetryStore(history=1024)
+    results.append(measure('add_history', history.add, frame_tuples, repeat))
+    decoder = SmartportDecoder()
+    results.append(measure('read_bluetooth', lambda buffer: telemetry.decode_buffer(decoder, buffer),
+                           chunks, repeat))
+    results[-1]['frames_per_second'] = results[-1]['throughput'] * frames / len(chunks)
+    bindings = [telemetry.SensorBinding(sensor) for sensor in MONITOR.values()]
+
+    def update_sensors(tick):
+        for binding in bindings:
+            binding.value()
+
+    results.append(measure('update_sensors', update_sensors, range(1000), repeat))
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'frames': frames,
+            'bytes': len(data),
+            'corrupt': corrupt,
+            'chunk': chunk,
+            'decoder': {'frames': decoder.frames, 'crc_errors': decoder.crc_errors,
+                        'resyncs': decoder.resyncs},
+            'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Telemetry hot path benchmark')
+    parser.add_argument('--frames', type=int, default=50000)
+    parser.add_argument('--corrupt', type=float, default=0.02, help='share of frames with a bad CRC')
+    parser.add_argument('--chunk', type=int, default=20, help='bytes per read')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='json file to save the results')
+    parser.add_argument('--compare', help='json file of a previous run')
+    args = parser.parse_args()
+    report = run(args.frames, args.corrupt, args.chunk, args.seed, args.repeat)
+    previous = {}
+    if args.compare:
+        with open(args.compare) as file:
+            previous = {result['stage']: result for result in json.load(file)['results']}
+    print('{:<16}{:>14}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'stage', 'items/s', 'p50 ns', 'p90 ns', 'p99 ns', 'alloc B', 'change'))
+    for result in report['results']:
+        change = ''
+        if result['stage'] in previous:
+            change = '{:+.1%}'.format(result['throughput'] / previous[result['stage']]['throughput'] - 1)
+        print('{:<16}{:>14.0f}{:>10}{:>10}{:>10}{:>10.1f}{:>10}'.format(
+            result['stage'], result['throughput'], result['latency_ns']['p50'],
+            result['latency_ns']['p90'], result['latency_ns']['p99'],
+            result['alloc_bytes_per_item'], change))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
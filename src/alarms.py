@@ -0,0 +1,123 @@
+"""
+           Alarms
+
+ Alarm rules of all monitors, evaluated from the reader thread each time
+ their telemetry slot changes
+
+"""
+
+import operator
+from telemetry import SensorBinding
+
+CONDITIONS = {
+    'lower': operator.lt,
+    'equal': operator.eq,
+    'higher': operator.gt,
+}
+
+# direction of the hysteresis band from the threshold to clear the alarm
+RELEASE = {
+    'lower': 1,
+    'equal': 0,
+    'higher': -1,
+}
+
+
+class AlarmRule():
+
+    # A tile alarm compiled from its config. The alarm becomes active when
+    # the condition holds for debounce seconds, is announced again every
+    # interval seconds while active (0 announces once) and clears when the
+    # value crosses back past the threshold by hysteresis
+
+    __slots__ = ('key', 'binding', 'slot', 'condition', 'threshold', 'release', 'hysteresis',
+                 'debounce', 'interval', 'text', 'active', 'since', 'announced', 'value')
+
+    def __init__(self, sensor, store=None, key=None):
+        self.key = key
+        self.binding = SensorBinding(sensor, store)
+        self.slot = self.binding.slot
+        name = sensor['alarm_condition'] if sensor['alarm_condition'] in CONDITIONS else 'lower'
+        self.condition = CONDITIONS[name]
+        self.threshold = sensor['alarm_value']
+        self.hysteresis = sensor.get('alarm_hysteresis', 0.0)
+        self.release = self.threshold + RELEASE[name] * self.hysteresis
+        self.debounce = sensor.get('alarm_debounce', 0.0)
+        self.interval = sensor['alarm_interval']
+        self.text = sensor['alarm_text'].replace('%s', sensor['name']).replace('%u', sensor['unit'])
+        self.active = False
+        self.since = None
+        self.announced = 0.0
+        self.value = None
+
+    def evaluate(self, timestamp):
+        # True when the alarm has to be announced
+        value = self.binding.value()
+        if value is None:
+            return False
+        self.value = value
+        if self.active:
+            if not self.condition(value, self.release):
+                self.active = False
+                self.since = None
+            elif self.interval and timestamp - self.announced >= self.interval:
+                self.announced = timestamp
+                return True
+            return False
+        if not self.condition(value, self.threshold):
+            self.since = None
+            return False
+        if self.since is None:
+            self.since = timestamp
+        if timestamp - self.since < self.debounce:
+            return False
+        self.active = True
+        self.announced = timestamp
+        return True
+
+    def message(self):
+        return self.text.replace('%v', str(self.value))
+
+
+class AlarmEngine():
+
+    # Rules are keyed by (monitor uuid, tile) and replaced as a whole by
+    # compile(), so the reader thread always sees a consistent set. The
+    # engine watches a slot from the first time a rule uses it. on_alarm is
+    # called with the rule from the reader thread of the slot's device.
+    # Without a store each rule uses the store of its tile's device
+
+    def __init__(self, on_alarm, store=None):
+        self.on_alarm = on_alarm
+        self.store = store
+        self.rules = {}
+        self.by_slot = {}
+        self.watched = set()
+
+    def compile(self, monitors):
+        rules = {}
+        by_slot = {}
+        for uuid, monitor in monitors.items():
+            for cont in range(1, 7):
+                index = 'sensor' + str(cont)
+                sensor = monitor[index]
+                if not sensor['alarm'] or not sensor['data_id']:
+                    continue
+                rule = AlarmRule(sensor, self.store, (uuid, index))
+                rules[rule.key] = rule
+                by_slot.setdefault(rule.slot, []).append(rule)
+        self.rules = rules
+        self.by_slot = by_slot
+        for slot in by_slot:
+            if slot not in self.watched:
+                self.watched.add(slot)
+                slot.watchers.append(self.check)
+
+    def check(self, slot):
+        for rule in self.by_slot.get(slot, ()):
+            if rule.evaluate(slot.timestamp):
+                self.on_alarm(rule)
+
+    def active(self, uuid, index):
+        rule = self.rules.get((uuid, index))
+        return rule is not None and rule.active
@@ -0,0 +1,478 @@
+"""
+           Bluetooth transports
+
+ Classic and BLE connections and the background reader. Doesn't need Kivy,
+ the bluetooth backends are imported on first use
+
+"""
+
+from functools import partial
+import threading
+import logging
+import random
+import time
+import os
+import sys
+
+
+def get_platform():
+    # same values as kivy.utils.platform
+    if os.environ.get('KIVY_BUILD', '') in ('android', 'ios'):
+        return os.environ['KIVY_BUILD']
+    if 'P4A_BOOTSTRAP' in os.environ or 'ANDROID_ARGUMENT' in os.environ:
+        return 'android'
+    if sys.platform in ('win32', 'cygwin'):
+        return 'win'
+    if sys.platform == 'darwin':
+        return 'macosx'
+    if sys.platform.startswith('linux') or sys.platform.startswith('freebsd'):
+        return 'linux'
+    return 'unknown'
+
+
+platform = get_platform()
+bluetooth = None
+DiscoveryService = None
+DeviceBle = None
+backends_lock = threading.Lock()
+backends_loaded = False
+
+READ_SIZE = 256
+RING_SIZE = 4096
+BACKOFF_MIN = 0.1
+BACKOFF_MAX = 5.0
+
+
+class BluetoothExtendedError(Exception):
+    pass
+
+
+class ByteRing():
+
+    # Preallocated byte buffer between a producer thread and the reader.
+    # peek() returns a view of the oldest bytes, without copying, that stays
+    # valid until consume(). Bytes arriving with the ring full are dropped
+    # and counted in overruns, so unconsumed bytes are never overwritten
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.head = 0
+        self.tail = 0
+        self.overruns = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def write(self, data):
+        data = memoryview(data)
+        with self.lock:
+            free = self.size - (self.head - self.tail)
+            if len(data) > free:
+                self.overruns += len(data) - free
+                data = data[:free]
+            start = self.head % self.size
+            first = min(len(data), self.size - start)
+            self.view[start:start + first] = data[:first]
+            self.view[:len(data) - first] = data[first:]
+            self.head += len(data)
+
+    def peek(self, lenght):
+        # contiguous part only, the rest is returned by the next peek
+        with self.lock:
+            start = self.tail % self.size
+            count = min(lenght, self.head - self.tail, self.size - start)
+        return self.view[start:start + count]
+
+    def consume(self, count):
+        with self.lock:
+            self.tail += count
+
+    def clear(self):
+        with self.lock:
+            self.tail = self.head
+
+
+def load_backends():
+    # BLE is optional, DeviceBle stays None without gattlib. Called by the
+    # concurrent scan threads, the lock keeps them out until every import
+    # has finished
+    global bluetooth, DiscoveryService, DeviceBle, UUID, backends_loaded
+    with backends_lock:
+        if backends_loaded:
+            return
+        try:
+            if platform == 'win' or platform == 'linux' or platform == 'macosx':
+                import bluetooth
+            if platform == 'android':
+                from jnius import autoclass
+                UUID = autoclass('java.util.UUID')
+                bluetooth = autoclass('android.bluetooth.BluetoothAdapter')
+        except ImportError as error:
+            bluetooth = None
+            raise BluetoothExtendedError(5, 'Bluetooth not available: ' + str(error))
+        if platform == 'linux':
+            try:
+                from gattlib import DiscoveryService, GATTRequester
+            except ImportError:
+                backends_loaded = True
+                return
+
+            class DeviceBle(GATTRequester):
+
+                # Notifications are written to the ring from the gattlib thread
+
+                def init(self):
+                    self.ring = ByteRing()
+                    self.pending = 0
+
+                def on_notification(self, handle, data):
+                    self.ring.write(memoryview(data)[3:])
+
+                def read(self, lenght):
+                    # the returned view is valid until the next read, a lost
+                    # link raises once the buffered data has been read
+                    self.ring.consume(self.pending)
+                    view = self.ring.peek(lenght)
+                    self.pending = len(view)
+                    if not len(view) and not self.is_connected():
+                        raise BluetoothExtendedError(4, 'Software disconnection')
+                    return view
+
+        backends_loaded = True
+
+
+class BluetoothExtended():
+
+    def __init__(self, **kwargs):
+        self.isConnected = False
+        self.root = True
+        self.timeout = None
+
+    def get_bonded_devices(self):
+        load_backends()
+        if platform == 'android':
+            if bluetooth.getDefaultAdapter().isEnabled() == False:
+                raise BluetoothExtendedError(1, 'Bluetooth not enabled')
+            return bluetooth.getDefaultAdapter().getBondedDevices().toArray()
+
+    def scan_devices(self):
+        if platform == 'win' or platform == 'linux' or platform == 'macosx':
+            root = True
+            devices = {'classic': self.scan_classic(4), 'ble': []}
+            if platform == 'linux':
+                try:
+                    devices['ble'] = self.scan_ble(2)
+                except RuntimeError as error:
+                    root = False
+            return devices, root
+
+    def scan_classic(self, duration):
+        # duration in units of 1.28 s
+        load_backends()
+        try:
+            return bluetooth.discover_devices(
+                duration=duration,
+                lookup_names=True,
+                flush_cache=True,
+                lookup_class=False)
+        except OSError as error:
+            if error.args[0] == 19:
+                raise BluetoothExtendedError(1, 'Bluetooth not enabled')
+            else:
+                raise BluetoothExtendedError(
+                    10, 'Unknown error: ' + error.args[1])
+
+    def scan_ble(self, duration):
+        # RuntimeError when not run as root
+        load_backends()
+        if DiscoveryService is None:
+            raise BluetoothExtendedError(5, 'BLE not available')
+        service = DiscoveryService("hci0")
+        return list(service.discover(duration).items())
+
+    def connect(self, address, type):
+        if self.isConnected:
+            # reconnect after a lost link
+            try:
+                self.disconnect()
+            except Exception:
+                self.isConnected = False
+        load_backends()
+        if platform == 'win' or platform == 'linux' or platform == 'macosx':
+            if type == 'classic':
+                port = 1
+                self.socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+                try:
+                    self.socket.connect((address, port))
+                except bluetooth.btcommon.BluetoothError as error:
+                    if error.args[0] == 112:
+                        raise BluetoothExtendedError(2, 'Couldn\'t connect')
+                    else:
+                        raise BluetoothExtendedError(
+                            10, 'Unknown error: ' + error.args[1])
+                else:
+                    if self.timeout is not None:
+                        self.socket.settimeout(self.timeout)
+                    self.type = 'classic'
+                    self.isConnected = True
+                    return
+            if type == 'ble' and platform == 'linux':
+                if DeviceBle is None:
+                    raise BluetoothExtendedError(5, 'BLE not available')
+                self.type = 'ble'
+                self.device = DeviceBle(address)
+                self.device.init()
+                self.isConnected = True
+                return
+        if platform == 'android':
+            devices = bluetooth.getDefaultAdapter().getBondedDevices().toArray()
+            if not bluetooth.getDefaultAdapter().isEnabled():
+                raise BluetoothExtendedError(5, 'Bluetooth not available')
+            for device in devices:
+                logging.info('{} {}'.format(device.getType(), device.getName()))
+                if device.getAddress() == address:
+                    logging.info('Connecting')
+                    if device.getType() == 1:
+                        try:
+                            self.socket = device.createRfcommSocketToServiceRecord(
+                                UUID.fromString("00001101-0000-1000-8000-00805F9B34FB"))
+                            self.socket.connect()
+                        except Exception as error:
+                            logging.info(error.args)
+                            raise BluetoothExtendedError(2, 'Couldn\'t connect')
+                        else:
+                            self.isConnected = True
+                            return
+                    if device.getType() == 2:
+                        raise BluetoothExtendedError(5, 'BLE not implemented')
+                        # bluetoothGatt = device.connectGatt(this, False, gattCallback)
+        raise BluetoothExtendedError(2, 'Couldn\'t connect')
+
+    #def gattCallback(self):
+    #    pass
+
+
+    def disconnect(self):
+        if platform == 'linux' and self.type == 'ble':
+            self.device.disconnect()
+        else:
+            self.socket.close()
+        self.isConnected = False
+
+    def read(self, lenght):
+        if platform == 'win' or platform == 'linux' or platform == 'macosx':
+            if self.type == 'classic':
+                buffer = bytearray(0)
+                try:
+                    buffer = self.socket.recv(lenght)
+                except bluetooth.btcommon.BluetoothError as error:
+                    if error.args[0] == 'timed out':
+                        raise BluetoothExtendedError(3, 'Read timeout')
+                    if error.args[0] == 103:
+                        raise BluetoothExtendedError(4, 'Software disconnection')
+                    if error.args[0] == 11:
+                        raise BluetoothExtendedError(5, 'Bluetooth not available')
+                    else:
+                        raise BluetoothExtendedError(
+                            10, 'Unknown error: ' + str(error.args))
+                return buffer
+            if self.type == 'ble':
+                return self.device.read(lenght)
+        if platform == 'android':
+            buffer = [0] * lenght
+            lenght = self.socket.read(buffer, 0, lenght)
+            return bytearray(buffer[0:lenght])
+
+
+class DeviceScanner():
+
+    # Scans classic and BLE devices concurrently in short rounds, so devices
+    # are reported as they are found and cancel() takes effect within a
+    # round. on_device(type, address, name) is called once per device and
+    # on_done(error, root) when both scans end, from the scan threads.
+    # Devices seen are cached for ttl seconds
+
+    def __init__(self, bluetooth_extended, rounds=3, ttl=600):
+        self.bluetooth_extended = bluetooth_extended
+        self.rounds = rounds
+        self.ttl = ttl
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.event_cancel = threading.Event()
+        self.pending = 0
+
+    def cached(self):
+        # (type, address, name) of the devices seen within ttl
+        now = time.monotonic()
+        with self.lock:
+            return [(type, address, name) for address, (type, name, seen) in self.cache.items()
+                    if now - seen < self.ttl]
+
+    def start(self, on_device, on_done):
+        self.on_device = on_device
+        self.on_done = on_done
+        if self.pending:
+            # the running scan reports to the new callbacks
+            self.event_cancel.clear()
+            return
+        self.event_cancel.clear()
+        self.found = set()
+        self.error = None
+        self.root = True
+        scans = [('classic', partial(self.bluetooth_extended.scan_classic, 1))]
+        if platform == 'linux':
+            scans.append(('ble', partial(self.bluetooth_extended.scan_ble, 1)))
+        self.pending = len(scans)
+        for type, function in scans:
+            threading.Thread(name='thread_scan_' + type, target=self.scan, args=(type, function),
+                             daemon=True).start()
+
+    def cancel(self):
+        self.event_cancel.set()
+
+    def scan(self, type, function):
+        try:
+            for _ in range(self.rounds):
+                if self.event_cancel.is_set():
+                    break
+                for address, name in function():
+                    self.add(type, address, name)
+        except BluetoothExtendedError as error:
+            self.error = error
+        except RuntimeError:
+            self.root = False
+        except Exception as error:
+            self.error = BluetoothExtendedError(10, 'Unknown error: ' + str(error.args))
+        with self.lock:
+            self.pending -= 1
+            done = self.pending == 0
+        if done:
+            self.on_done(self.error, self.root)
+
+    def add(self, type, address, name):
+        with self.lock:
+            self.cache[address] = (type, name, time.monotonic())
+            new = address not in self.found
+            self.found.add(address)
+        if new and not self.event_cancel.is_set():
+            self.on_device(type, address, name)
+
+
+class LinkStats():
+
+    # Link quality counters, written by the reader thread. rates() returns
+    # the byte, frame and CRC error rates since its previous call, the
+    # frame counters come from the decoder
+
+    def __init__(self, decoder=None):
+        self.decoder = decoder
+        self.bytes = 0
+        self.reconnects = 0
+        self.disconnected = 0.0
+        self.outage = 0.0
+        self.lost = None
+        self.last = (time.monotonic(), 0, 0, 0)
+
+    def link_lost(self):
+        self.lost = time.monotonic()
+
+    def link_restored(self):
+        self.outage = time.monotonic() - self.lost
+        self.disconnected += self.outage
+        self.lost = None
+        self.reconnects += 1
+
+    def rates(self):
+        now = time.monotonic()
+        frames = self.decoder.frames if self.decoder else 0
+        errors = self.decoder.crc_errors if self.decoder else 0
+        then, last_bytes, last_frames, last_errors = self.last
+        self.last = (now, self.bytes, frames, errors)
+        elapsed = max(now - then, 1e-6)
+        checked = frames - last_frames + errors - last_errors
+        return {'connected': self.lost is None,
+                'reconnects': self.reconnects,
+                'disconnected': self.disconnected + (now - self.lost if self.lost else 0.0),
+                'byte_rate': (self.bytes - last_bytes) / elapsed,
+                'frame_rate': (frames - last_frames) / elapsed,
+                'crc_error_rate': (errors - last_errors) / checked if checked else 0.0}
+
+
+class BluetoothReader(threading.Thread):
+
+    # Owns the device while connected and drains it continuously. Received
+    # buffers go to on_data and fatal errors to on_error, both called from
+    # the reader thread. With reconnect set to (address, type) a lost link
+    # is reconnected with exponential backoff and jitter instead, on_link
+    # is called with False when the link is lost and True when restored
+
+    def __init__(self, device, on_data, on_error, reconnect=None, on_link=None, stats=None):
+        super().__init__(name='thread_read', daemon=True)
+        self.device = device
+        self.on_data = on_data
+        self.on_error = on_error
+        self.reconnect = reconnect
+        self.on_link = on_link
+        self.stats = stats or LinkStats()
+        self.event_stop = threading.Event()
+
+    def run(self):
+        while not self.event_stop.is_set():
+            try:
+                buffer = self.device.read(READ_SIZE)
+            except BluetoothExtendedError as error:
+                if error.args[0] == 3:
+                    continue
+                if self.reconnect and self.recover():
+                    continue
+                if not self.event_stop.is_set():
+                    self.on_error(error)
+                break
+            except Exception as error:
+                # socket closed by stop()
+                if self.reconnect and not self.event_stop.is_set() and self.recover():
+                    continue
+                if not self.event_stop.is_set():
+                    self.on_error(BluetoothExtendedError(10, 'Unknown error: ' + str(error.args)))
+                break
+            if self.event_stop.is_set():
+                # stopped while reading, the data is no longer wanted
+                break
+            if len(buffer):
+                self.stats.bytes += len(buffer)
+                self.on_data(buffer)
+            else:
+                self.event_stop.wait(0.005)
+        if platform == 'android':
+            from jnius import detach
+            detach()
+
+    def recover(self):
+        # True once reconnected, False if stopped first
+        self.stats.link_lost()
+        if self.on_link:
+            self.on_link(False)
+        delay = BACKOFF_MIN
+        while not self.event_stop.wait(random.uniform(delay / 2, delay)):
+            try:
+                self.device.connect(*self.reconnect)
+            except Exception as error:
+                logging.info('Reconnect failed: {}'.format(error.args))
+                delay = min(delay * 2, BACKOFF_MAX)
+                continue
+            if self.event_stop.is_set():
+                # stopped while connecting, the caller saw the link as lost
+                # and won't close the new one
+                self.device.disconnect()
+                return False
+            self.stats.link_restored()
+            if self.on_link:
+                self.on_link(True)
+            return True
+        return False
+
+    def stop(self):
+        self.event_stop.set()
@@ -0,0 +1,135 @@
+"""
+           Link capture and replay
+
+ Capture file: header b'SPCAP' + version (1 byte) + start time (double)
+ followed by records of monotonic time since start (double), length
+ (uint16) and the received bytes
+
+"""
+
+import struct
+import time
+from bluetooth_extended import BluetoothExtendedError
+
+MAGIC = b'SPCAP'
+VERSION = 1
+HEADER = struct.Struct('<5sBd')
+RECORD = struct.Struct('<dH')
+
+
+class CaptureWriter():
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self.start = time.monotonic()
+
+    def write(self, data):
+        # records are limited to 64 KiB
+        for offset in range(0, len(data), 0xFFFF):
+            chunk = data[offset:offset + 0xFFFF]
+            self.file.write(RECORD.pack(time.monotonic() - self.start, len(chunk)))
+            self.file.write(chunk)
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    # yields (timestamp, data) for each record
+    with open(path, 'rb') as file:
+        magic, version, start = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a capture file: ' + path)
+        while True:
+            record = file.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            timestamp, lenght = RECORD.unpack(record)
+            data = file.read(lenght)
+            if len(data) < lenght:
+                return
+            yield timestamp, data
+
+
+def load_capture(path):
+    # whole capture as data, chunk offsets and chunk times, for decode_capture()
+    data = bytearray()
+    offsets = []
+    times = []
+    for timestamp, chunk in read_capture(path):
+        offsets.append(len(data))
+        times.append(timestamp)
+        data += chunk
+    return bytes(data), offsets, times
+
+
+class CaptureTransport():
+
+    # Wraps a transport and records every chunk it returns
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self.writer = None
+
+    @property
+    def isConnected(self):
+        return self.transport.isConnected
+
+    def connect(self, address, type):
+        # a reconnect keeps writing to the same capture
+        self.transport.connect(address, type)
+        if self.writer is None:
+            self.writer = CaptureWriter(self.path)
+
+    def disconnect(self):
+        self.transport.disconnect()
+        self.writer.close()
+        self.writer = None
+
+    def read(self, lenght):
+        data = self.transport.read(lenght)
+        if len(data):
+            self.writer.write(data)
+        return data
+
+
+class ReplayTransport():
+
+    # Plays a capture file back with the BluetoothExtended interface. speed
+    # is a multiple of real time, 0 replays as fast as possible
+
+    def __init__(self, speed=1.0):
+        self.isConnected = False
+        self.speed = speed
+        self.type = 'replay'
+
+    def connect(self, address, type):
+        try:
+            self.records = read_capture(address)
+            self.timestamp, self.data = next(self.records, (0, b''))
+        except (OSError, ValueError) as error:
+            raise BluetoothExtendedError(2, 'Couldn\'t open capture ' + str(error))
+        self.offset = 0
+        self.start = time.monotonic()
+        self.isConnected = True
+
+    def disconnect(self):
+        self.records.close()
+        self.isConnected = False
+
+    def read(self, lenght):
+        if self.offset >= len(self.data):
+            try:
+                self.timestamp, self.data = next(self.records)
+            except StopIteration:
+                raise BluetoothExtendedError(4, 'End of capture')
+            self.offset = 0
+        if self.speed:
+            delay = self.start + self.timestamp / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        data = self.data[self.offset:self.offset + lenght]
+        self.offset += len(data)
+        return data
@@ -0,0 +1,120 @@
+"""
+           Config store
+
+ Json file of the app config with the keys, reads and deletes of kivy's
+ JsonStore. The file is read once, changes are written by a background
+ thread after a short delay and replace the file atomically
+
+"""
+
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+
+class ConfigStore():
+
+    # Assigning a key keeps a copy of the value and schedules a write
+    # delay seconds after the last change, or max_delay seconds after the
+    # first one while changes keep coming, in a single write. Values
+    # are replaced and never changed in place, so writes serialize a
+    # shallow copy without holding up the callers. The file is written to
+    # path.tmp, synced and renamed over path, so a crash leaves either the
+    # old or the new config. flush() writes pending changes at once, for
+    # pause and exit
+
+    def __init__(self, path, delay=1.0, max_delay=5.0):
+        self.path = path
+        self.delay = delay
+        self.max_delay = max_delay
+        self.first = 0.0
+        self.changed = 0.0
+        self.data = {}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.timer = None
+        self.dirty = False
+        self.writes = 0
+        if os.path.isfile(path):
+            try:
+                with open(path) as file:
+                    self.data = json.load(file)
+            except (OSError, ValueError) as error:
+                logging.warning('Couldn\'t read {}: {}'.format(path, error))
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return copy.deepcopy(self.data[key])
+
+    def __setitem__(self, key, value):
+        value = copy.deepcopy(value)
+        with self.lock:
+            self.data[key] = value
+            self.schedule()
+
+    def delete(self, key):
+        with self.lock:
+            del self.data[key]
+            self.schedule()
+
+    def schedule(self):
+        # called with the lock held. The timer isn't restarted on each
+        # change, when it fires early it waits again for the rest
+        now = time.monotonic()
+        if not self.dirty:
+            self.first = now
+        self.changed = now
+        self.dirty = True
+        if self.timer is None:
+            self.start_timer(self.delay)
+
+    def start_timer(self, delay):
+        # called with the lock held
+        self.timer = threading.Timer(delay, self.expire)
+        self.timer.name = 'thread_config'
+        self.timer.daemon = True
+        self.timer.start()
+
+    def expire(self):
+        with self.lock:
+            if self.timer is not threading.current_thread():
+                # flushed meanwhile
+                return
+            remaining = min(self.changed + self.delay, self.first + self.max_delay) - time.monotonic()
+            if remaining > 0:
+                self.start_timer(remaining)
+                return
+        self.flush()
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return
+                data = dict(self.data)
+                self.dirty = False
+            temporary = self.path + '.tmp'
+            try:
+                with open(temporary, 'w') as file:
+                    json.dump(data, file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temporary, self.path)
+            except OSError as error:
+                # kept pending for the next change or flush
+                with self.lock:
+                    self.dirty = True
+                logging.warning('Couldn\'t write {}: {}'.format(self.path, error))
+                return
+            self.writes += 1
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+"""
+           Headless telemetry daemon
+
+ Decodes a bluetooth device, a capture file or the simulator without Kivy
+ and streams the values as json lines or binary records to stdout, a file
+ or a socket
+
+ python3 headless.py --device 00:11:22:33:44:55 --type classic
+ python3 headless.py --replay capture.spcap --speed 0 --format binary -o out.splog
+ python3 headless.py --simulator --output tcp:localhost:5760
+
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from bluetooth_extended import BluetoothExtended, BluetoothExtendedError, BluetoothReader
+from smartport import frame_values, sensor_registry, SmartportDecoder
+from telemetry_log import HEADER, MAGIC, RECORD, VERSION
+
+
+def open_output(output, format):
+    # file object for '-', a path, tcp:host:port or unix:path
+    if output == '-':
+        return sys.stdout.buffer
+    if output.startswith('tcp:'):
+        host, port = output[4:].rsplit(':', 1)
+        connection = socket.create_connection((host, int(port)))
+        return connection.makefile('wb')
+    if output.startswith('unix:'):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(output[5:])
+        return connection.makefile('wb')
+    return open(output, 'wb')
+
+
+class Daemon():
+
+    # Decodes on the reader thread and writes each chunk's frames at once.
+    # Json lines carry the wall clock time as the telemetry server does,
+    # binary records the time since the header's start like the app's log
+
+    def __init__(self, transport, output, format, reconnect=None):
+        self.transport = transport
+        self.output = output
+        self.format = format
+        self.reconnect = reconnect
+        self.decoder = SmartportDecoder()
+        self.error = None
+        self.event_done = threading.Event()
+        self.offset = time.time() - time.monotonic()
+        self.start = time.monotonic()
+        if format == 'binary':
+            output.write(HEADER.pack(MAGIC, VERSION, self.start + self.offset))
+
+    def on_data(self, buffer):
+        frames = [frame for frame in self.decoder.feed(buffer) if frame[1] == 0x10]
+        if not frames:
+            return
+        timestamp = time.monotonic()
+        if self.format == 'binary':
+            data = b''.join([RECORD.pack(timestamp - self.start, frame[0], frame[2], frame[3])
+                             for frame in frames])
+        else:
+            data = ''.join([json.dumps({'t': round(timestamp + self.offset, 4), 'sensor_id': frame[0],
+                                        'data_id': frame[2], 'raw': frame[3],
+                                        'values': frame_values(frame)}) + '\n'
+                            for frame in frames]).encode()
+        try:
+            self.output.write(data)
+            self.output.flush()
+        except (BrokenPipeError, ConnectionError) as error:
+            self.on_error(BluetoothExtendedError(4, 'Output closed: ' + str(error)))
+
+    def on_error(self, error):
+        self.error = error
+        self.event_done.set()
+
+    def run(self):
+        self.reader = BluetoothReader(self.transport, self.on_data, self.on_error, self.reconnect)
+        self.reader.start()
+        try:
+            while not self.event_done.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.reader.stop()
+        if self.transport.isConnected:
+            self.transport.disconnect()
+        self.reader.join(1)
+
+
+def create_transport(args):
+    if args.replay:
+        from capture import ReplayTransport
+        return ReplayTransport(args.speed), args.replay, 'replay'
+    if args.simulator:
+        from simulator import SimulatedHub
+        return SimulatedHub(rate=args.rate), '', 'simulator'
+    transport = BluetoothExtended()
+    transport.timeout = 0.5
+    return transport, args.device, args.type
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless SmartPort telemetry decoder')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--device', help='bluetooth address')
+    source.add_argument('--replay', help='capture file to replay')
+    source.add_argument('--simulator', action='store_true', help='simulated sensor hub')
+    parser.add_argument('--type', default='classic', choices=('classic', 'ble', 'android'),
+                        help='bluetooth device type')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 as fast as possible')
+    parser.add_argument('--rate', type=int, default=100, help='simulator frames per second')
+    parser.add_argument('--reconnect', action='store_true', help='reconnect a lost bluetooth link')
+    parser.add_argument('--format', default='json', choices=('json', 'binary'))
+    parser.add_argument('-o', '--output', default='-', help='-, a file, tcp:host:port or unix:path')
+    parser.add_argument('--sensors', default='sensors.json', help='custom sensor definitions')
+    args = parser.parse_args()
+    if os.path.isfile(args.sensors):
+        sensor_registry.load(args.sensors)
+    transport, address, type = create_transport(args)
+    reconnect = (address, type) if args.reconnect and not args.replay else None
+    try:
+        output = open_output(args.output, args.format)
+    except OSError as error:
+        parser.exit(1, 'Couldn\'t open output: {}\n'.format(error))
+    try:
+        transport.connect(address, type)
+    except BluetoothExtendedError as error:
+        parser.exit(1, '{}\n'.format(error.args[1]))
+    daemon = Daemon(transport, output, args.format, reconnect)
+    daemon.run()
+    if output is not sys.stdout.buffer:
+        output.close()
+    if daemon.error and daemon.error.args[0] != 4:
+        parser.exit(1, '{}\n'.format(daemon.error.args[1]))
+
+
+if __name__ == '__main__':
+    main()
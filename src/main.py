@@ -11,6 +11,12 @@
 
 __version__ = "0.1"
 
+import os
+import time
+# startup stages are printed when set, 'exit' also stops after the first frame
+STARTUP_TIMINGS = os.environ.get('SMARTPORT_STARTUP_TIMINGS')
+startup_timings = [('start', time.perf_counter())]
+
 from kivy.app import App
 from kivy.lang import Builder
 from kivy.uix.screenmanager import ScreenManager, Screen
@@ -18,30 +24,33 @@ from kivy.uix.button import Button
 from kivy.uix.textinput import TextInput
 from kivy.uix.popup import Popup
 from kivy.uix.checkbox import CheckBox
+from kivy.uix.widget import Widget
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.graphics import Color, Line
 from kivy.factory import Factory
 from kivy.core.window import Window
-from kivy.storage.jsonstore import JsonStore
 from kivy.clock import Clock
 from kivy.utils import platform
-from plyer import tts
 from functools import partial
-import threading
 import re # floatinput
 import struct
 import json
 import uuid
-import time
-import logging
+import copy
+import glob
+from smartport import sensor_registry, SmartportDecoder
+from bluetooth_extended import BluetoothExtended, BluetoothExtendedError, BluetoothReader, DeviceScanner, LinkStats
+from capture import CaptureTransport, ReplayTransport
+from simulator import SimulatedHub
+from telemetry import telemetry, decode_buffer, get_store, SensorBinding
+from telemetry_log import TelemetryLogger
+from alarms import AlarmEngine
+from speech import SpeechQueue, ALARM
+from metrics import metrics
+from config_store import ConfigStore
+startup_timings.append(('imports', time.perf_counter()))
 Builder.load_file('smartportbt_kv.kv')
-
-if platform == 'win' or platform == 'linux' or platform == 'macosx':
-    import bluetooth
-if platform == 'linux':
-    from gattlib import DiscoveryService, GATTRequester, GATTResponse
-if platform == 'android':
-    from jnius import autoclass
-    bluetooth = autoclass('android.bluetooth.BluetoothAdapter')
-    UUID = autoclass('java.util.UUID')
+startup_timings.append(('kv', time.perf_counter()))
 
 class FloatInput(TextInput):
 
@@ -56,153 +65,6 @@ class FloatInput(TextInput):
         return super(FloatInput, self).insert_text(s, from_undo=from_undo)
 
 
-class BluetoothExtendedError(Exception):
-    pass
-
-
-if platform == 'linux':
-    class DeviceBle(GATTRequester):
-
-        """def __init__(self, address, **kwargs):
-            self.del_buffer = False
-            self.buffer = bytearray(0)"""
-
-        def init(self):
-            self.del_buffer = False
-            self.buffer = bytearray(0)
-        
-        def on_notification(self, handle, data):
-            if self.del_buffer:
-                self.buffer = bytearray(0)
-                self.del_buffer = False
-            self.buffer += data[3:len(data)]
-
-
-class BluetoothExtended():
-
-    def __init__(self, **kwargs):
-        self.isConnected = False 
-        self.root = True       
-
-    def get_bonded_devices(self):
-        if platform == 'android':
-            if bluetooth.getDefaultAdapter().isEnabled() == False:
-                raise BluetoothExtendedError(1, 'Bluetooth not enabled')
-            return bluetooth.getDefaultAdapter().getBondedDevices().toArray()
-
-    def scan_devices(self):
-        if platform == 'win' or platform == 'linux' or platform == 'macosx':
-            root = True
-            devices = {'classic': [], 'ble': []}
-            # bt classic
-            try:
-                devices['classic'] = bluetooth.discover_devices(
-                    duration=4,
-                    lookup_names=True,
-                    flush_cache=True,
-                    lookup_class=False)
-            except OSError as error:
-                if error.args[0] == 19:
-                    raise BluetoothExtendedError(1, 'Bluetooth not enabled')
-                else:
-                    raise BluetoothExtendedError(
-                        10, 'Unknown error: ' + error.args[1])
-                return
-            # bt ble
-            if platform == 'linux':
-                service = DiscoveryService("hci0")
-                try:
-                    devices_ble = service.discover(2)
-                except RuntimeError as error:
-                    root = False
-                else:
-                    for key in devices_ble:
-                        devices['ble'].append((key, devices_ble[key]))
-            return devices, root
-
-    def connect(self, address, type):
-        if platform == 'win' or platform == 'linux' or platform == 'macosx':
-            if type == 'classic':
-                port = 1
-                self.socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-                try:
-                    self.socket.connect((address, port))
-                except bluetooth.btcommon.BluetoothError as error:
-                    if error.args[0] == 112:
-                        raise BluetoothExtendedError(2, 'Couldn\'t connect')
-                    else:
-                        raise BluetoothExtendedError(
-                            10, 'Unknown error: ' + error.args[1])
-                else:
-                    self.type = 'classic'
-                    self.isConnected = True
-                    return
-            if type == 'ble' and platform == 'linux':
-                self.type = 'ble'
-                self.device = DeviceBle(address)
-                self.device.init()
-                self.isConnected = True
-                return
-        if platform == 'android':
-            devices = bluetooth.getDefaultAdapter().getBondedDevices().toArray()
-            if not bluetooth.getDefaultAdapter().isEnabled():
-                raise BluetoothExtendedError(5, 'Bluetooth not available')
-            for device in devices:
-                logging.info('{} {}'.format(device.getType(), device.getName()))
-                if device.getAddress() == address:
-                    logging.info('Connecting')
-                    if device.getType() == 1:
-                        try:
-                            self.socket = device.createRfcommSocketToServiceRecord(
-                                UUID.fromString("00001101-0000-1000-8000-00805F9B34FB"))
-                            self.socket.connect()
-                        except Exception as error:
-                            logging.info(error.args)
-                            raise BluetoothExtendedError(2, 'Couldn\'t connect')
-                        else:
-                            self.isConnected = True
-                            return
-                    if device.getType() == 2:
-                        raise BluetoothExtendedError(5, 'BLE not implemented')
-                        # bluetoothGatt = device.connectGatt(this, False, gattCallback)
-        raise BluetoothExtendedError(2, 'Couldn\'t connect')
-
-    #def gattCallback(self):
-    #    pass
-
-
-    def disconnect(self):
-        self.socket.close()
-        self.isConnected = False
-
-    def read(self, lenght):
-        if platform == 'win' or platform == 'linux' or platform == 'macosx':
-            if self.type == 'classic':
-                buffer = bytearray(0) 
-                try:
-                    buffer = self.socket.recv(20)
-                except bluetooth.btcommon.BluetoothError as error:
-                    if error.args[0] == 'timed out':
-                        raise BluetoothExtendedError(3, 'Read timeout')
-                    if error.args[0] == 103:
-                        raise BluetoothExtendedError(4, 'Software disconnection')
-                    if error.args[0] == 11:
-                        raise BluetoothExtendedError(5, 'Bluetooth not available')
-                    else:
-                        raise BluetoothExtendedError(
-                            10, 'Unknown error: ' + str(error.args))
-                return buffer
-            if self.type == 'ble':
-                if self.device.del_buffer == False:
-                    self.device.del_buffer = True
-                    return self.device.buffer
-                return bytearray(0)
-        if platform == 'android':
-            buffer = [0] * 20
-            lenght = self.socket.read(buffer, 0, 20)
-            return bytearray(buffer[0:lenght])
-
-
 class LongpressButton(Button):
     __events__ = ('on_short_press', 'on_long_press',)
 
@@ -232,30 +94,101 @@ class ButtonSensor(LongpressButton):
     pass
 
 
+class ListRow(RecycleDataViewBehavior, LongpressButton):
+
+    # Row of a RecycleList. The keys of its data item are set as attributes,
+    # release, short_press and long_press are called with the row. Rows are
+    # reused for other items when scrolling, so keep the item, not the row
+
+    release = None
+    short_press = None
+    long_press = None
+
+    def refresh_view_attrs(self, rv, index, data):
+        self.item = data
+        return super(ListRow, self).refresh_view_attrs(rv, index, data)
+
+    def on_release(self):
+        if self.release:
+            self.release(self)
+
+    def on_short_press(self, *largs):
+        if self.short_press:
+            self.short_press(self)
+
+    def on_long_press(self, *largs):
+        if self.long_press:
+            self.long_press(self)
+
+
+class SensorGraph(Widget):
+
+    # Line plot of a slot series over the last span seconds, at most one
+    # point every two pixels so redraws don't depend on the history size
+
+    span = 300
+    stats_window = 60
+
+    def plot(self, series, multiplier):
+        self.canvas.clear()
+        if series is None:
+            return ''
+        times, values = series.points(max(int(self.width / 2), 2), self.span)
+        if len(times) < 2:
+            return ''
+        low = min(values)
+        high = max(values)
+        if high == low:
+            high = low + 1
+        x_scale = self.width / (times[-1] - times[0] or 1)
+        y_scale = self.height / (high - low)
+        points = []
+        for t, value in zip(times, values):
+            points += [self.x + (t - times[0]) * x_scale, self.y + (value - low) * y_scale]
+        with self.canvas:
+            Color(0.2, 0.8, 0.2, 1)
+            Line(points=points, width=1.2)
+        low, high, mean = series.stats(self.stats_window)
+        return 'min {:.2f}  max {:.2f}  mean {:.2f}  ({} s)'.format(
+            low * multiplier, high * multiplier, mean * multiplier, self.stats_window)
+
+
 class ScreenMonitors(Screen):
 
+    # connections by device key, kept after disconnecting so the decoder
+    # counters keep adding up
+
+    connections = {}
+
+    def monitor_item(self, uuid):
+        # list item of a monitor
+        return {'text': config[uuid]['name'], 'uuid': uuid,
+                'short_press': self.show_screen_monitor, 'long_press': self.show_popup_monitors}
+
+    def remove_monitor_item(self, item):
+        self.ids.list_config.data = [listed for listed in self.ids.list_config.data if listed is not item]
+
     def add_monitor(self):
-        button = Factory.ButtonList(text='')
-        button.uuid = str(uuid.uuid1())
-        button.bind(on_long_press=self.show_popup_monitors)
-        button.bind(on_short_press=screen_monitors.show_screen_monitor)
-        self.ids.list_config.add_widget(button)
-        screen_edit_name.origin = button
+        key = str(uuid.uuid1())
+        config[key] = copy.deepcopy(monitor)
+        item = self.monitor_item(key)
+        self.ids.list_config.data.append(item)
+        screen_edit_name.origin = item
         screen_edit_name.ids.text_name.text = ''
-        config[button.uuid] = monitor
         screen_manager.current = 'screen_edit_name'
 
     def delete_monitor(self, obj):
-        self.ids.list_config.remove_widget(self.popup.origin)
-        if self.popup.origin.uuid in config:
-            del config[self.popup.origin.uuid]
-            store.delete(self.popup.origin.uuid)
+        self.remove_monitor_item(self.popup.origin)
+        if self.popup.origin['uuid'] in config:
+            del config[self.popup.origin['uuid']]
+            store.delete(self.popup.origin['uuid'])
+            compile_alarms()
         self.popup.dismiss()
 
     def show_popup_monitors(self, obj):
         popup_list = Factory.PopupMonitors()
         self.popup = popup_list
-        popup_list.origin = obj
+        popup_list.origin = obj.item
         popup_list.ids.rename.bind(on_release=self.show_screen_edit_name)
         popup_list.ids.delete.bind(on_release=self.delete_monitor)
         popup_list.open()
@@ -264,9 +197,12 @@ class ScreenMonitors(Screen):
         popup_about = Factory.PopupAbout()
         popup_about.open()
 
+    def show_screen_diagnostics(self):
+        screen_manager.current = 'screen_diagnostics'
+
     def show_screen_edit_name(self, obj):
         screen_edit_name.origin = self.popup.origin
-        screen_edit_name.ids.text_name.text = self.popup.origin.text
+        screen_edit_name.ids.text_name.text = self.popup.origin['text']
         screen_manager.current = 'screen_edit_name'
         self.popup.dismiss()
 
@@ -279,65 +215,111 @@ class ScreenMonitors(Screen):
             screen_monitor.ids[index].sensor_data_id = config[obj.uuid][index]['data_id']
             screen_monitor.ids[index].sensor_index = config[obj.uuid][index]['index']
             screen_monitor.ids[index].sensor_id = config[obj.uuid][index]['sensor_id']
+            screen_monitor.ids[index].sensor_device = config[obj.uuid][index].get('device', '')
         screen_monitor.ids.title.title = obj.text
+        screen_monitor.bind_sensors()
         screen_manager.current = 'screen_monitor'
 
+    def connected(self):
+        return [connection for connection in self.connections.values() if connection.connected]
+
     def connect(self):
-        if bluetooth_extended.isConnected:
+        # connects every device in the settings, a device that fails is
+        # reported and skipped
+        if self.connected():
+            self.disconnect()
+            return
+        devices = config['settings']['devices']
+        if not devices:
+            smartport_app.show_toast('Select bluetooth device')
+            return
+        errors = []
+        if config['settings'].get('server', False):
             try:
-                self.timer_read.cancel()
-                self.timer_update.cancel()
-            except:
-                pass
-            bluetooth_extended.disconnect()
-            self.ids.image_connection.icon = 'data/circle-red.png'
-            self.ids.button_connection.text = 'Connect'
-        else:
+                start_server()
+            except OSError as error:
+                errors.append('Couldn\'t start server: ' + str(error.strerror))
+        for device in devices:
+            key = device_key(device)
+            connection = self.connections.get(key)
+            if connection is None:
+                connection = self.connections[key] = Connection(device)
+            connection.device = device
             try:
-                bluetooth_extended.connect(config['settings']['bt']['address'], config['settings']['bt']['type'])
+                connection.connect(len(devices) > 1)
             except BluetoothExtendedError as error:
-                Clock.schedule_once(partial(smartport_app.show_toast, error.args[1]), 1)
-            except KeyError:
-                smartport_app.show_toast('Select bluetooth device')
-            else:
-                self.timer_read = Clock.schedule_interval(read_bluetooth, 0.01)
-                self.timer_update = Clock.schedule_interval(
-                    screen_monitor.update_sensors, 0.02)
-                self.ids.image_connection.icon = 'data/circle-green.png'
-                self.ids.button_connection.text = 'Disconnect'
-                screen_manager.current = 'screen_monitors'
+                errors.append(device_message(connection, error.args[1]))
+        if errors:
+            Clock.schedule_once(partial(smartport_app.show_toast, '\n'.join(errors)), 1)
+        if self.connected():
+            self.update_connection()
+            screen_manager.current = 'screen_monitors'
+
+    def disconnect(self, *args):
+        for connection in self.connected():
+            connection.disconnect()
+        self.update_connection()
+
+    def connection_lost(self, connection, error, *args):
+        if not connection.connected:
+            return
+        smartport_app.show_toast(device_message(connection, error.args[1]))
+        connection.disconnect()
+        self.update_connection()
+
+    def link_changed(self, connection, connected, *args):
+        if not connection.connected or not connection.reader.is_alive():
+            return
+        if connected:
+            smartport_app.show_toast(device_message(
+                connection, 'Reconnected after {:.1f} s'.format(connection.link_stats.outage)))
+        else:
+            smartport_app.show_toast(device_message(connection, 'Connection lost, reconnecting'))
+        self.update_connection()
+
+    def update_connection(self):
+        # green while every connected device has its link up
+        connected = self.connected()
+        if connected and all(connection.link_stats.lost is None for connection in connected):
+            self.ids.image_connection.icon = 'data/circle-green.png'
+        else:
+            self.ids.image_connection.icon = 'data/circle-red.png'
+        self.ids.button_connection.text = 'Disconnect' if connected else 'Connect'
 
     def show_screen_settings(self):
-        try:
-            screen_settings.ids.device.text = config['settings']['bt']['name']
-        except Exception as e:
-            print(e.args)
+        screen_settings.devices = [dict(device) for device in config['settings']['devices']]
+        screen_settings.list_devices()
+        screen_settings.ids.capture.active = config['settings'].get('capture', False)
+        screen_settings.ids.log.active = config['settings'].get('log', False)
+        screen_settings.ids.reconnect.active = config['settings'].get('reconnect', False)
+        screen_settings.ids.server.active = config['settings'].get('server', False)
+        screen_settings.ids.replay_speed.text = str(config['settings'].get('replay_speed', 1.0))
         screen_manager.current = 'screen_settings'
 
 
 class ScreenSettings(Screen):
-    
+
+    scanning = False
+    devices = []
+
+    def device_item(self, type, address, name):
+        return {'text': name or address, 'device_name': name, 'device_address': address,
+                'device_type': type, 'release': self.select_device}
+
     def list_bluetooth(self):
-        screen_list.ids.list.clear_widgets()
+        screen_list.ids.list.data = []
         if platform == 'win' or platform == 'linux' or platform == 'macosx':
-            try:
-                devices, root = bluetooth_extended.scan_devices()
-            except BluetoothExtendedError as error:
-                Clock.schedule_once(partial(smartport_app.show_toast, error.args[1]), 1)
-                return
-            screen_list.ids.actionbar.title = 'Available devices'
+            # devices seen recently are listed at once, the scan adds the rest
+            screen_list.ids.actionbar.title = 'Scanning...'
             screen_list.previous = 'screen_settings'
             screen_manager.current = 'screen_list'
-            if root == False:
-                Clock.schedule_once(partial(smartport_app.show_toast, 'Run as administrator to scan for ble devices'), 1)
-            for key in devices:
-                for address, name in devices[key]:
-                    button = Factory.ButtonList(text=name or address)
-                    button.device_name = name
-                    button.device_address = address
-                    button.device_type = key
-                    button.bind(on_release=self.select_device)
-                    screen_list.ids.list.add_widget(button)
+            self.listed = set()
+            self.found = 0
+            self.scanning = True
+            self.list_offline_devices()
+            for type, address, name in device_scanner.cached():
+                self.add_device(type, address, name)
+            device_scanner.start(self.device_found, self.scan_done)
         if platform == 'android':
             try:
                 devices = bluetooth_extended.get_bonded_devices()
@@ -347,29 +329,76 @@ class ScreenSettings(Screen):
             screen_list.ids.actionbar.title = 'Paired devices'
             screen_list.previous = 'screen_settings'
             screen_manager.current = 'screen_list'
-            for device in devices:
-                button = Factory.ButtonList(text=device.getName())
-                button.device_name = device.getName()
-                button.device_address = device.getAddress()
-                button.device_type = 'android'
-                button.bind(on_release=self.select_device)
-                screen_list.ids.list.add_widget(button)
+            screen_list.ids.list.data = [self.device_item('android', device.getAddress(), device.getName())
+                                         for device in devices]
+            self.list_offline_devices()
+
+    def device_found(self, type, address, name):
+        # called from the scan threads
+        Clock.schedule_once(partial(self.add_device, type, address, name))
+
+    def scan_done(self, error, root):
+        # called from the scan threads
+        Clock.schedule_once(partial(self.show_scan_result, error, root))
+
+    def add_device(self, type, address, name, *args):
+        if not self.scanning or address in self.listed:
+            return
+        self.listed.add(address)
+        # above the offline devices
+        screen_list.ids.list.data.insert(self.found, self.device_item(type, address, name))
+        self.found += 1
+
+    def show_scan_result(self, error, root, *args):
+        if not self.scanning:
+            return
+        screen_list.ids.actionbar.title = 'Available devices'
+        if error:
+            smartport_app.show_toast(error.args[1])
+        elif root == False:
+            smartport_app.show_toast('Run as administrator to scan for ble devices')
+
+    def stop_scan(self):
+        self.scanning = False
+        device_scanner.cancel()
+
+    def list_offline_devices(self):
+        items = [self.device_item('simulator', '', 'Simulator')]
+        for path in sorted(glob.glob('*' + CAPTURE_EXTENSION)):
+            items.append(self.device_item('replay', path, path))
+        screen_list.ids.list.data.extend(items)
 
     def select_device(self, instance):
-        self.ids.device.device_name = instance.device_name
-        self.ids.device.device_address = instance.device_address
-        self.ids.device.device_type = instance.device_type
-        self.ids.device.text = instance.device_name
-        screen_list.ids.list.clear_widgets()
+        self.stop_scan()
+        device = {'name': instance.device_name, 'address': instance.device_address, 'type': instance.device_type}
+        if device_key(device) not in [device_key(listed) for listed in self.devices]:
+            self.devices.append(device)
+        self.list_devices()
+        screen_list.ids.list.data = []
         screen_manager.current = 'screen_settings'
 
+    def list_devices(self):
+        self.ids.devices.clear_widgets()
+        for device in self.devices:
+            button = Factory.ButtonList(text=device['name'] or device['address'])
+            button.device = device
+            button.bind(on_long_press=self.remove_device)
+            self.ids.devices.add_widget(button)
+
+    def remove_device(self, instance):
+        self.devices.remove(instance.device)
+        self.list_devices()
+
     def update_settings(self):
+        config['settings']['devices'] = self.devices
+        config['settings']['capture'] = self.ids.capture.active
+        config['settings']['log'] = self.ids.log.active
+        config['settings']['reconnect'] = self.ids.reconnect.active
+        config['settings']['server'] = self.ids.server.active
         try:
-            config['settings']['bt']['name'] = self.ids.device.device_name
-            config['settings']['bt']['address'] = self.ids.device.device_address
-            config['settings']['bt']['type'] = self.ids.device.device_type
-        except:
-            pass
+            config['settings']['replay_speed'] = float(self.ids.replay_speed.text)
+        except ValueError:
+            config['settings']['replay_speed'] = 1.0
         store['settings'] = config['settings']
         screen_manager.current = 'screen_monitors'
 
@@ -379,9 +408,79 @@ class ScreenSettings(Screen):
 
 class ScreenMonitor(Screen):
 
+    def __init__(self, **kwargs):
+        super(ScreenMonitor, self).__init__(**kwargs)
+        self.tiles = {}
+        self.trigger_update = Clock.create_trigger(self.update_sensors)
+        self.graph_tile = None
+        self.graph_event = None
+        self.alarm_tiles = {}
+        self.blink_event = None
+        hide_widget(self.ids.graph_box)
+
     def show_screen_monitors(self):
+        self.unbind_sensors()
         screen_manager.current = 'screen_monitors'
 
+    def toggle_graph(self, button):
+        # a short press on a tile shows its history, on the same tile hides it
+        if self.graph_event:
+            self.graph_event.cancel()
+            self.graph_event = None
+        if self.graph_tile is button or button not in self.tiles:
+            self.graph_tile = None
+            self.ids.graph.canvas.clear()
+            hide_widget(self.ids.graph_box)
+            return
+        self.graph_tile = button
+        hide_widget(self.ids.graph_box, False)
+        self.draw_graph()
+        self.graph_event = Clock.schedule_interval(self.draw_graph, 0.5)
+
+    def draw_graph(self, *args):
+        binding = self.tiles.get(self.graph_tile)
+        if binding is None:
+            return
+        multiplier = binding.multiplier if binding.read is None else 1
+        stats = self.ids.graph.plot(binding.series, multiplier)
+        self.ids.graph_label.text = self.graph_tile.sensor_name + '  ' + stats
+
+    def bind_sensors(self):
+        # tiles are compiled into bindings and refreshed only when their
+        # telemetry slot changes
+        self.unbind_sensors()
+        for cont in range(1, 7):
+            button_index = 'sensor' + str(cont)
+            sensor = config[self.uuid][button_index]
+            if sensor['data_id']:
+                binding = SensorBinding(sensor)
+                binding.slot.watchers.append(self.trigger_update)
+                button = self.ids[button_index]
+                self.tiles[button] = binding
+                if sensor['alarm']:
+                    self.alarm_tiles[button] = button_index
+                if sensor.get('callout', 0) > 0:
+                    speech.add_callout(button, sensor['callout'],
+                                       partial(callout, SensorBinding(sensor), sensor))
+        if self.alarm_tiles:
+            self.blink_event = Clock.schedule_interval(self.blink_alarms, 0.5)
+        self.trigger_update()
+
+    def unbind_sensors(self):
+        if self.graph_tile:
+            self.toggle_graph(self.graph_tile)
+        for button, binding in self.tiles.items():
+            if self.trigger_update in binding.slot.watchers:
+                binding.slot.watchers.remove(self.trigger_update)
+            speech.remove_callout(button)
+        self.tiles = {}
+        if self.blink_event:
+            self.blink_event.cancel()
+            self.blink_event = None
+        for button in self.alarm_tiles:
+            button.background_color = [1, 1, 1, 1]
+        self.alarm_tiles = {}
+
     def show_screen_edit_sensor(self, obj):
         screen_edit_sensor.sensor = obj
         screen_edit_sensor.sensor_name = obj.sensor_name
@@ -389,6 +488,7 @@ class ScreenMonitor(Screen):
         screen_edit_sensor.sensor_data_id = obj.sensor_data_id
         screen_edit_sensor.sensor_index = obj.sensor_index
         screen_edit_sensor.sensor_unit = obj.sensor_unit
+        screen_edit_sensor.sensor_device = obj.sensor_device
         screen_edit_sensor.ids.multiplier.text = str(
             config[self.uuid][obj.index]['multiplier'])
         if obj.sensor_index == 2:
@@ -411,147 +511,95 @@ class ScreenMonitor(Screen):
             config[self.uuid][obj.index]['alarm_interval'])
         screen_edit_sensor.ids.alarm_value.text = str(
             config[self.uuid][obj.index]['alarm_value'])
+        screen_edit_sensor.ids.alarm_hysteresis.text = str(
+            config[self.uuid][obj.index].get('alarm_hysteresis', 0.0))
+        screen_edit_sensor.ids.alarm_debounce.text = str(
+            config[self.uuid][obj.index].get('alarm_debounce', 0.0))
         screen_edit_sensor.ids.alarm_text.text = config[self.uuid][obj.index]['alarm_text']
+        screen_edit_sensor.ids.callout.text = str(config[self.uuid][obj.index].get('callout', 0))
         obj.background_color = [1, 1, 1, 1]
         screen_manager.current = 'screen_edit_sensor'
 
     def update_sensors(self, ts):
-        if self.uuid in config:
-            for cont in range(1, 7):
-                update = False
-                button_index = 'sensor' + str(cont)
-                if config[self.uuid][button_index]['index'] == 2:
-                    try:
-                        cells = telemetry[config[self.uuid][button_index]['sensor_id']
-                                          ][config[self.uuid][button_index]['data_id']][2]
-                    except KeyError:
-                        pass
-                    else:
-                        update = True
-                        sum = 0.0
-                        max = 0.0
-                        min = 10.0
-                        for key in cells.keys():
-                            if config[self.uuid][button_index]['value'] == 'sum':
-                                sum += cells[key]
-                            if config[self.uuid][button_index]['value'] == 'max' or config[self.uuid][button_index]['value'] == 'delta':
-                                if cells[key] > max:
-                                    max = cells[key]
-                            if config[self.uuid][button_index]['value'] == 'min' or config[self.uuid][button_index]['value'] == 'delta':
-                                if cells[key] < min and cells[key] > 0:
-                                    min = cells[key]
-                        if config[self.uuid][button_index]['value'] == 'sum':
-                            value = sum
-                        if config[self.uuid][button_index]['value'] == 'min':
-                            value = min
-                        if config[self.uuid][button_index]['value'] == 'max':
-                            value = max
-                        if config[self.uuid][button_index]['value'] == 'delta':
-                            value = max-min
-                        value = float('{:.2f}'.format(value))
-                elif config[self.uuid][button_index]['index'] == 0 or config[self.uuid][button_index]['index'] == 1:
-                    try:
-                        value = telemetry[config[self.uuid][button_index]['sensor_id']][config[self.uuid][button_index]
-                                                                                        ['data_id']][config[self.uuid][button_index]['index']] * config[self.uuid][button_index]['multiplier']
-                    except KeyError:
-                        pass
-                    else:
-                        value = float('{:.2f}'.format(value))
-                        update = True
-                if update:  # update text and alarm
-                    self.ids[button_index].sensor_value = value
-                    if config[self.uuid][button_index]['alarm']:
-                        condition = {'higher': config[self.uuid][button_index]['alarm_condition'] == 'higher' and self.ids[button_index].sensor_value > config[uuid][button_index]['alarm_value'],
-                                     'equal': config[self.uuid][button_index]['alarm_condition'] == 'equal' and self.ids[button_index].sensor_value == config[self.uuid][button_index]['alarm_value'],
-                                     'lower': config[self.uuid][button_index]['alarm_condition'] == 'lower' and self.ids[button_index].sensor_value < config[self.uuid][button_index]['alarm_value']
-                                     }
-                        if condition['higher'] or condition['equal'] or condition['lower']:
-                            try:
-                                screen_monitor.ids[button_index].alarm_voice.is_triggered
-                            except AttributeError:
-                                screen_monitor.ids[button_index].alarm_voice = Clock.create_trigger(
-                                    screen_monitor.alarms, config[screen_monitor.uuid][button_index]['alarm_interval'])
-                            try:
-                                screen_monitor.ids[button_index].alarm_blink.is_triggered
-                            except AttributeError:
-                                screen_monitor.ids[button_index].alarm_blink = Clock.create_trigger(
-                                    screen_monitor.alarms, 0.5)
-                            if not screen_monitor.ids[button_index].alarm_voice.is_triggered:
-                                screen_monitor.ids[button_index].alarm_voice()
-                                global text_voice
-                                text_voice = config[self.uuid][button_index]['alarm_text']
-                                text_voice = text_voice.replace(
-                                    '%s', config[self.uuid][button_index]['name'])
-                                text_voice = text_voice.replace(
-                                    '%v', str(value))
-                                text_voice = text_voice.replace(
-                                    '%u', config[self.uuid][button_index]['unit'])
-                                event_voice.set()
-                            if not screen_monitor.ids[button_index].alarm_blink.is_triggered:
-                                screen_monitor.ids[button_index].alarm_blink()
-                                color = self.ids[button_index].background_color
-                                self.ids[button_index].background_color = (
-                                    1, int(not color[1]), int(not color[2]), 1)
-                        else:
-                            self.ids[button_index].background_color = [
-                                1, 1, 1, 1]
-
-    def alarms(self, interval):
-        pass
+        start = time.perf_counter()
+        for button, binding in self.tiles.items():
+            if not binding.changed():
+                continue
+            value = binding.value()
+            if value is None:
+                continue
+            button.sensor_value = value
+        UPDATE_SECONDS.observe(time.perf_counter() - start)
+
+    def blink_alarms(self, dt):
+        # alarm state is kept by the alarm engine, tiles only read it
+        for button, index in self.alarm_tiles.items():
+            if alarm_engine.active(self.uuid, index):
+                color = button.background_color
+                button.background_color = (1, int(not color[1]), int(not color[2]), 1)
+            elif button.background_color != [1, 1, 1, 1]:
+                button.background_color = [1, 1, 1, 1]
 
 
 class ScreenEditName(Screen):
 
     def update_name(self):
-        config[self.origin.uuid]['name'] = self.ids.text_name.text
-        store[self.origin.uuid] = config[self.origin.uuid]
-        self.origin.text = self.ids.text_name.text
+        config[self.origin['uuid']]['name'] = self.ids.text_name.text
+        store[self.origin['uuid']] = config[self.origin['uuid']]
+        self.origin['text'] = self.ids.text_name.text
+        screen_monitors.ids.list_config.refresh_from_data()
         self.ids.text_name.text = ''
         screen_manager.current = 'screen_monitors'
 
     def cancel_name(self):
-        if self.origin.text == '':
-            screen_monitors.ids.list_config.remove_widget(self.origin)
-            del config[self.origin.uuid]
+        if self.origin['text'] == '':
+            screen_monitors.remove_monitor_item(self.origin)
+            del config[self.origin['uuid']]
         screen_manager.current = 'screen_monitors'
 
 
 class ScreenEditSensor(Screen):
 
     def show_sensor_list(self):
-        screen_list.ids.list.clear_widgets()
-        button = Factory.ButtonList(text='')
-        button.sensor_id = 0
-        button.sensor_data_id = 0
-        button.sensor_index = 0
-        button.sensor_unit = ''
-        button.bind(on_release=self.select_sensor)
-        screen_list.ids.list.add_widget(button)
-        for sensor_id in telemetry.keys():
-            if not sensor_id == 'sensor_id':
-                for data_id in telemetry[sensor_id].keys():
-                    sensor_data = get_sensor_data(data_id)
-                    if sensor_data:
-                        for index in sensor_data.keys():
-                            button = Factory.ButtonList(
-                                text=sensor_data[index]['name'])
-                            button.sensor_id = sensor_id
-                            button.sensor_data_id = data_id
-                            button.sensor_index = index
-                            button.sensor_unit = sensor_data[index]['unit']
-                            button.bind(on_release=self.select_sensor)
-                            screen_list.ids.list.add_widget(button)
+        # the first item clears the sensor, sensors received while the list
+        # is shown are added to it
+        screen_list.ids.list.data = [{'text': '', 'sensor_name': '', 'sensor_id': 0, 'sensor_data_id': 0,
+                                      'sensor_index': 0, 'sensor_unit': '', 'sensor_device': '',
+                                      'release': self.select_sensor}]
+        self.listed = set()
+        self.add_sensors()
+        screen_list.follow(self.add_sensors)
         screen_list.previous = 'screen_edit_sensor'
         screen_list.ids.actionbar.title = 'Available sensors'
         screen_manager.current = 'screen_list'
 
+    def add_sensors(self, *args):
+        items = []
+        connections = list(screen_monitors.connections.values())
+        for connection in connections:
+            for slot in connection.store.received():
+                key = (connection.key, slot.sensor_id, slot.data_id, slot.index)
+                if not slot.definition or key in self.listed:
+                    continue
+                self.listed.add(key)
+                text = slot.definition['name']
+                if len(connections) > 1:
+                    text += ' - ' + (connection.device['name'] or connection.key)
+                items.append({'text': text, 'sensor_name': slot.definition['name'], 'sensor_id': slot.sensor_id,
+                              'sensor_data_id': slot.data_id, 'sensor_index': slot.index,
+                              'sensor_unit': slot.definition['unit'], 'sensor_device': connection.key,
+                              'release': self.select_sensor})
+        if items:
+            screen_list.ids.list.data.extend(items)
+
     def select_sensor(self, sensor):
-        self.sensor_name = sensor.text
+        self.sensor_name = sensor.sensor_name
         self.sensor_id = sensor.sensor_id
         self.sensor_data_id = sensor.sensor_data_id
         self.sensor_unit = sensor.sensor_unit
         self.sensor_index = sensor.sensor_index
-        screen_list.ids.list.clear_widgets()
+        self.sensor_device = sensor.sensor_device
+        screen_list.ids.list.data = []
         screen_manager.current = 'screen_edit_sensor'
 
     def update_sensor(self):
@@ -560,6 +608,7 @@ class ScreenEditSensor(Screen):
         config[screen_monitor.uuid][self.sensor.index]['data_id'] = self.sensor_data_id
         config[screen_monitor.uuid][self.sensor.index]['unit'] = self.sensor_unit
         config[screen_monitor.uuid][self.sensor.index]['index'] = self.sensor_index
+        config[screen_monitor.uuid][self.sensor.index]['device'] = self.sensor_device
         config[screen_monitor.uuid][self.sensor.index]['multiplier'] = float(
             self.ids.multiplier.text)
         if config[screen_monitor.uuid][self.sensor.index]['index'] == 2:
@@ -583,34 +632,129 @@ class ScreenEditSensor(Screen):
                 self.ids.alarm_interval.text)
         except ValueError:
             config[screen_monitor.uuid][self.sensor.index]['alarm_interval'] = 15
-        screen_monitor.ids[self.sensor.index].alarm_voice = Clock.create_trigger(
-            screen_monitor.alarms, config[screen_monitor.uuid][self.sensor.index]['alarm_interval'])
-        screen_monitor.ids[self.sensor.index].alarm_blink = Clock.create_trigger(
-            screen_monitor.alarms, 0.5)
         try:
-            config[screen_monitor.uuid][self.sensor.index]['alarm_value'] = int(
+            config[screen_monitor.uuid][self.sensor.index]['alarm_value'] = float(
                 self.ids.alarm_value.text)
         except ValueError:
             config[screen_monitor.uuid][self.sensor.index]['alarm_value'] = 0
+        try:
+            config[screen_monitor.uuid][self.sensor.index]['alarm_hysteresis'] = float(
+                self.ids.alarm_hysteresis.text)
+        except ValueError:
+            config[screen_monitor.uuid][self.sensor.index]['alarm_hysteresis'] = 0.0
+        try:
+            config[screen_monitor.uuid][self.sensor.index]['alarm_debounce'] = float(
+                self.ids.alarm_debounce.text)
+        except ValueError:
+            config[screen_monitor.uuid][self.sensor.index]['alarm_debounce'] = 0.0
         config[screen_monitor.uuid][self.sensor.index]['alarm_text'] = self.ids.alarm_text.text
+        try:
+            config[screen_monitor.uuid][self.sensor.index]['callout'] = float(self.ids.callout.text)
+        except ValueError:
+            config[screen_monitor.uuid][self.sensor.index]['callout'] = 0
         store[screen_monitor.uuid] = config[screen_monitor.uuid]
+        compile_alarms()
         self.sensor.sensor_name = self.sensor_name
         self.sensor.sensor_id = self.sensor_id
         self.sensor.sensor_data_id = self.sensor_data_id
         self.sensor.sensor_unit = self.sensor_unit
         self.sensor.sensor_index = self.sensor_index
+        self.sensor.sensor_device = self.sensor_device
+        screen_monitor.bind_sensors()
         screen_manager.current = 'screen_monitor'
 
     def show_screen_monitor(self):
         screen_manager.current = 'screen_monitor'
 
 
+class ScreenDiagnostics(Screen):
+
+    # Metrics refreshed every second while shown
+
+    def on_enter(self):
+        self.update_metrics()
+        self.event = Clock.schedule_interval(self.update_metrics, 1)
+
+    def on_leave(self):
+        self.event.cancel()
+
+    def update_metrics(self, *args):
+        lines = []
+        connected = screen_monitors.connected()
+        for connection in connected:
+            if len(connected) > 1:
+                lines.append(connection.device['name'] or connection.key)
+            for key, value in connection.link_stats.rates().items():
+                lines.append('{:<36}{:>12.6g}'.format(key, float(value)))
+        for name, value in metrics.snapshot().items():
+            if isinstance(value, dict) and 'buckets' in value:
+                mean = value['sum'] / value['count'] if value['count'] else 0
+                lines.append('{:<36}{:>12} mean {:.6g}'.format(name, value['count'], mean))
+            elif isinstance(value, dict):
+                for key, count in value.items():
+                    lines.append('{:<36}{:>12}'.format('{}[{}]'.format(name, key), count))
+            else:
+                lines.append('{:<36}{:>12.6g}'.format(name, float(value)))
+        self.ids.metrics.text = '\n'.join(lines)
+
+    def save_metrics(self, format):
+        path = time.strftime('diagnostics-%Y%m%d-%H%M%S') + ('.json' if format == 'json' else '.prom')
+        with open(path, 'w') as file:
+            file.write(metrics.to_json() if format == 'json' else metrics.to_prometheus())
+        smartport_app.show_toast('Saved ' + path)
+
+    def show_screen_monitors(self):
+        screen_manager.current = 'screen_monitors'
+
+
 class ScreenList(Screen):
 
+    update_event = None
+
+    def follow(self, function):
+        # function adds new items every 0.5 s while the list is shown
+        self.update_event = Clock.schedule_interval(function, 0.5)
+
+    def on_leave(self):
+        if self.update_event:
+            self.update_event.cancel()
+            self.update_event = None
+
     def previous_screen(self):
+        if screen_settings.built():
+            screen_settings.stop_scan()
         screen_manager.current = self.previous
 
 
+class LazyScreenManager(ScreenManager):
+
+    # Screens in factories are built the first time they are shown or used
+
+    factories = {}
+
+    def get_screen(self, name):
+        if name in self.factories and not self.has_screen(name):
+            self.add_widget(self.factories[name](name=name))
+        return super(LazyScreenManager, self).get_screen(name)
+
+
+class LazyScreen():
+
+    # Stands for a screen global until the screen is built
+
+    def __init__(self, name):
+        object.__setattr__(self, 'name', name)
+
+    def __getattr__(self, attribute):
+        return getattr(screen_manager.get_screen(self.name), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(screen_manager.get_screen(self.name), attribute, value)
+
+    def built(self):
+        return screen_manager.has_screen(self.name)
+
+
 class SmartportApp(App):
 
     def show_toast(self, message, *args):
@@ -625,140 +769,155 @@ class SmartportApp(App):
     def build(self):
         return screen_manager
 
-
-def check_crc(packet):
-    crc = 0
-    for c in range(2, 10):
-        crc += packet[c]
-        crc += crc >> 8
-        crc &= 0x00FF
-    crc = 0xFF - crc
-    if crc == 0:
+    def on_pause(self):
+        store.flush()
         return True
-    return False
-
-
-def add_telemetry(packet):
-    sensor_id = packet[1]
-    frame_id = packet[2]
-    data_id = packet[4] << 8 | packet[3]
-    value = packet[8] << 8 << 24 | packet[7] << 16 | packet[6] << 8 | packet[5]
-    if frame_id == 0x10:
-        sensor_data = get_sensor_data(data_id)
-        # logging.info('data: {} {} {} {}'.format(sensor_id, frame_id, data_id, value))
-        if sensor_data:
-            for key in sensor_data.keys():
-                if sensor_id not in telemetry:
-                    telemetry[sensor_id] = {}
-                if data_id not in telemetry[sensor_id]:
-                    if key == 2:
-                        telemetry[sensor_id][data_id] = {2: {}}
-                    else:
-                        telemetry[sensor_id][data_id] = {}
-                if key == 2:
-                    telemetry[sensor_id][data_id][2][value & 0x0000000F] = (
-                        (value & 0x000FFF00) >> 8) * sensor_data[2]['mult']
-                    telemetry[sensor_id][data_id][2][(
-                        value & 0x0000000F) + 1] = (value >> 20) * sensor_data[2]['mult']
-                elif key == 0:
-                    telemetry[sensor_id][data_id][0] = (
-                        value & 0x0000FFFF) * sensor_data[key]['mult']
-                elif key == 1:
-                    telemetry[sensor_id][data_id][1] = (
-                        value >> 16) * sensor_data[key]['mult']
-            # logging.info('telemetry: {}'.format(telemetry))
-
-
-def read_bluetooth(obj):
-    try:
-        buffer = bluetooth_extended.read(20)
-    except BluetoothExtendedError as error:
-        if error.args[0] == 4 or error.args[0] == 5:
-            smartport_app.show_toast(error.args[1])
-            screen_monitors.timer_read.cancel()
-            screen_monitors.timer_update.cancel()
-            bluetooth_extended.disconnect()
-            screen_monitors.ids.image_connection.icon = 'data/circle-red.png'
-            screen_monitors.ids.button_connection.text = 'Connect'
-        if error.args[0] == 10:
-            raise error
+
+    def on_stop(self):
+        store.flush()
+
+    def on_start(self):
+        if STARTUP_TIMINGS:
+            Clock.schedule_once(self.report_startup)
+
+    def report_startup(self, *args):
+        # called on the first frame
+        startup_timings.append(('first_frame', time.perf_counter()))
+        start = startup_timings[0][1]
+        for stage, timestamp in startup_timings[1:]:
+            print('startup {} {:.1f}'.format(stage, (timestamp - start) * 1000))
+        if STARTUP_TIMINGS == 'exit':
+            self.stop()
+
+
+class Connection():
+
+    # One device link with its own transport, reader thread, decoder and
+    # telemetry store, so the work per frame doesn't grow with the number
+    # of connected devices. A lost link only ends its own connection
+
+    def __init__(self, device):
+        self.device = device
+        self.key = device_key(device)
+        self.store = get_store(self.key)
+        self.decoder = SmartportDecoder()
+        self.transport = None
+        self.reader = None
+        self.logger = None
+        self.link_stats = LinkStats(self.decoder)
+        self.connected = False
+
+    def connect(self, suffix=False):
+        # suffix adds the device name to capture and log files
+        name = '-' + re.sub('[^0-9A-Za-z]+', '_', self.device['name'] or self.key) if suffix else ''
+        self.transport = create_transport(self.device, name)
+        self.transport.connect(self.device['address'], self.device['type'])
+        self.decoder.reset()
+        if config['settings'].get('log', False):
+            self.logger = TelemetryLogger(
+                time.strftime('telemetry-%Y%m%d-%H%M%S') + name, config['settings'].get('log_format', 'binary'))
+            self.logger.start()
+            self.store.logger = self.logger
+        self.store.publisher = telemetry_server
+        reconnect = None
+        if config['settings'].get('reconnect', False) and self.device['type'] != 'replay':
+            reconnect = (self.device['address'], self.device['type'])
+        self.link_stats = LinkStats(self.decoder)
+        self.reader = BluetoothReader(
+            self.transport, self.read, self.error, reconnect, self.link_changed, self.link_stats)
+        self.reader.start()
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+        self.reader.stop()
+        if self.transport.isConnected:
+            self.transport.disconnect()
+        # the decoder and store are reused on the next connect, a reader
+        # still blocked in a read exits without passing on what it got
+        self.reader.join(1)
+        if self.logger:
+            self.store.logger = None
+            self.logger.stop()
+            self.logger = None
+        self.store.publisher = None
+
+    def read(self, buffer):
+        # called from the reader thread
+        if self.store.publisher is not None and config['settings'].get('server_raw', False):
+            self.store.publisher.publish_raw(time.monotonic(), buffer, self.key)
+        decode_buffer(self.decoder, buffer, self.store)
+
+    def error(self, error):
+        # called from the reader thread, codes 4, 5 and 10 end the connection
+        Clock.schedule_once(partial(screen_monitors.connection_lost, self, error))
+
+    def link_changed(self, connected):
+        # called from the reader thread when reconnecting
+        Clock.schedule_once(partial(screen_monitors.link_changed, self, connected))
+
+
+def create_transport(device, name=''):
+    if device['type'] == 'replay':
+        transport = ReplayTransport(config['settings'].get('replay_speed', 1.0))
+    elif device['type'] == 'simulator':
+        transport = SimulatedHub()
     else:
-        global packet
-        for i in range(len(buffer)):
-            if buffer[i] == 0x7E:
-                packet = [0x7E]
-            elif len(packet) > 0:
-                if buffer[i] == 0x7D:
-                    i += 1
-                    packet.append(buffer[i] ^ 0x20)
-                else:
-                    packet.append(buffer[i])
-                if len(packet) == 10:
-                    if check_crc(packet):
-                        add_telemetry(packet)
-                    packet = []
-
-
-def get_sensor_data(data_id):
-    data = {
-        range(0x0100, 0x010f): {0: {'name': 'Alt', 'unit': 'm', 'mult': 1, 'shift': 0}},
-        range(0x0110, 0x011f): {0: {'name': 'Vario', 'unit': 'm/s', 'mult': 1, 'shift': 0.01}},
-        range(0x0200, 0x020f): {0: {'name': 'Curr', 'unit': 'A', 'mult': 0.1, 'shift': 0}},
-        range(0x0210, 0x021f): {0: {'name': 'VFAS', 'unit': 'v', 'mult': 0.01, 'shift': 0}},
-        range(0x0300, 0x030f): {2: {'name': 'Cell', 'unit': 'v', 'mult': 0.002, 'shift': 0}},
-        range(0x0400, 0x040f): {0: {'name': 'Temp1', 'unit': 'C', 'mult': 1, 'shift': 0}},
-        range(0x0410, 0x041f): {0: {'name': 'Temp2', 'unit': 'C', 'mult': 1, 'shift': 0}},
-        range(0x0500, 0x050f): {0: {'name': 'Rpm', 'unit': 'rpm', 'mult': 1, 'shift': 0}},
-        range(0x0600, 0x060f): {0: {'name': 'Fuel', 'unit': '%', 'mult': 0.01, 'shift': 0}},
-        range(0x0700, 0x070f): {0: {'name': 'AccX', 'unit': 'g', 'mult': 0.01, 'shift': 0}},
-        range(0x0710, 0x071f): {0: {'name': 'AccY', 'unit': 'g', 'mult': 0.01, 'shift': 0}},
-        range(0x0720, 0x072f): {0: {'name': 'AccZ', 'unit': 'g', 'mult': 0.01, 'shift': 0}},
-        range(0x0800, 0x080f): {0: {'name': 'GPSLong', 'unit': '', 'mult': 0.01, 'shift': 0},
-                                1: {'name': 'GPSLat', 'unit': '', 'mult': 0.01, 'shift': 16}},
-        range(0x0820, 0x082f): {0: {'name': 'GPSAlt', 'unit': 'm', 'mult': 0.01, 'shift': 0}},
-        range(0x0830, 0x083f): {0: {'name': 'GPSSpeed', 'unit': 'kts', 'mult': 0.001, 'shift': 0}},
-        range(0x0840, 0x084f): {0: {'name': 'GPSCours', 'unit': '\xf8', 'mult': 0.01, 'shift': 0}},
-        range(0x0850, 0x085f): {0: {'name': 'GPSTime', 'unit': 'g', 'mult': 0.01, 'shift': 0}},
-        range(0x0900, 0x090f): {0: {'name': 'A3', 'unit': 'v', 'mult': 0.01, 'shift': 0}},
-        range(0x0910, 0x091f): {0: {'name': 'A4', 'unit': 'v', 'mult': 0.01, 'shift': 0}},
-        range(0x0a00, 0x0a0f): {0: {'name': 'AirSpeed', 'unit': 'kts', 'mult': 0.01, 'shift': 0}},
-        range(0x0b00, 0x0b0f): {0: {'name': 'RboxBatt1', 'unit': 'v', 'mult': 0.001, 'shift': 0}},
-        range(0x0b10, 0x0b1f): {0: {'name': 'RboxBatt2', 'unit': 'v', 'mult': 0.001, 'shift': 0}},
-        range(0x0b20, 0x0b2f): {0: {'name': 'RboxState', 'unit': '', 'mult': 0.01, 'shift': 0}},
-        range(0x0b30, 0x0b3f): {0: {'name': 'RboxCons', 'unit': 'mAh', 'mult': 1, 'shift': 0}},
-        range(0x0b50, 0x0b5f): {0: {'name': 'EscV', 'unit': 'v', 'mult': 0.01, 'shift': 0},
-                                1: {'name': 'EscA', 'unit': 'A', 'mult': 0.01, 'shift': 16}},
-        range(0x0b60, 0x0b6f): {0: {'name': 'EscRpm', 'unit': 'rpm', 'mult': 100, 'shift': 0},
-                                1: {'name': 'EscCons', 'unit': 'mAh', 'mult': 1, 'shift': 0}},
-        range(0x0d00, 0x0d0f): {0: {'name': 'GassuitT1', 'unit': 'C', 'mult': 1, 'shift': 0}},
-        range(0x0d10, 0x0d1f): {0: {'name': 'GassuitT2', 'unit': 'C', 'mult': 1, 'shift': 0}},
-        range(0x0d20, 0x0d2f): {0: {'name': 'GassuitSpeed', 'unit': 'rpm', 'mult': 1, 'shift': 0}},
-        range(0x0d30, 0x0d3f): {0: {'name': 'GassuitResVol', 'unit': 'ml', 'mult': 1, 'shift': 0}},
-        range(0x0d40, 0x0d4f): {0: {'name': 'GassuitPerc', 'unit': '%', 'mult': 1, 'shift': 0}},
-        range(0x0d50, 0x0d5f): {0: {'name': 'GassuitFlow', 'unit': '%', 'mult': 1, 'shift': 0}},
-        range(0x0d60, 0x0d6f): {0: {'name': 'GassuitMaxFlow', 'unit': '%', 'mult': 1, 'shift': 0}},
-        range(0x0d70, 0x0d7f): {0: {'name': 'GassuitAvgFlow', 'unit': '%', 'mult': 1, 'shift': 0}},
-        range(0x0e50, 0x0e5f): {0: {'name': 'SBecV', 'unit': 'v', 'mult': 0.01, 'shift': 0},
-                                1: {'name': 'SBecA', 'unit': 'A', 'mult': 0.01, 'shift': 16}},
-        range(0xf101, 0xf102): {0: {'name': 'RSSI', 'unit': '', 'mult': 1, 'shift': 0}},
-        range(0xf102, 0xf103): {0: {'name': 'A1', 'unit': 'v', 'mult': 0.1, 'shift': 0}},
-        range(0xf103, 0xf104): {0: {'name': 'A2', 'unit': 'v', 'mult': 0.1, 'shift': 0}},
-        range(0xf104, 0xf105): {0: {'name': 'RXBT', 'unit': 'v', 'mult': 0.1, 'shift': 0}},
-        range(0xf105, 0xf106): {0: {'name': 'RAS', 'unit': '%', 'mult': 1, 'shift': 0}},
-        range(0x0a10, 0x0a1f): {0: {'name': 'FuelQty', 'unit': 'ml', 'mult': 0.01, 'shift': 0}},
-    }
+        transport = BluetoothExtended()
+        transport.timeout = 0.5
+    if config['settings'].get('capture', False):
+        transport = CaptureTransport(
+            transport, time.strftime('capture-%Y%m%d-%H%M%S') + name + CAPTURE_EXTENSION)
+    return transport
+
+
+def connections_total(part, counter):
+    # sum of a counter of all connections, None when none has the part
+    parts = [getattr(connection, part) for connection in list(screen_monitors.connections.values())]
+    parts = [part for part in parts if part is not None]
+    return sum(getattr(part, counter) for part in parts) if parts else None
+
 
-    for key in data:
-        if data_id in key:
-            return data[key]
+def start_server():
+    # the server keeps running once started so clients stay subscribed
+    # across connections, raises OSError
+    global telemetry_server
+    if telemetry_server is None:
+        from server import TelemetryServer
+        server = TelemetryServer(port=config['settings'].get('server_port', 5760),
+                                 ws_port=config['settings'].get('server_ws_port', 5761))
+        server.start()
+        telemetry_server = server
 
 
-def do_speak(event_voice):
-    global text_voice
-    while True:
-        event_voice.wait()
-        tts.speak(text_voice)
-        event_voice.clear()
+def device_key(device):
+    # the address, or the type for devices without one like the simulator
+    return device['address'] or device['type']
+
+
+def device_message(connection, message):
+    # prefixes the device name when several devices are connected
+    if len(config['settings']['devices']) > 1:
+        return '{}: {}'.format(connection.device['name'] or connection.key, message)
+    return message
+
+
+def compile_alarms():
+    alarm_engine.compile({key: value for key, value in config.items()
+                          if isinstance(value, dict) and value.get('type') == 'monitor'})
+
+
+def speak_alarm(rule):
+    # called from the reader thread
+    speech.say(rule.message(), rule.key, ALARM)
+
+
+def callout(binding, sensor):
+    # called from the speech thread
+    value = binding.value()
+    if value is None:
+        return None
+    return '{} {} {}'.format(sensor['name'], value, sensor['unit'])
 
 
 def hide_widget(wid, dohide=True):
@@ -771,20 +930,18 @@ def hide_widget(wid, dohide=True):
         wid.height, wid.size_hint_y, wid.opacity, wid.disabled = 0, None, 0, True
 
 
-text_voice = ''
+CAPTURE_EXTENSION = '.spcap'
+telemetry_server = None
+HISTORY = 1024
+
+if os.path.isfile('sensors.json'):
+    sensor_registry.load('sensors.json')
+
 smartport_app = SmartportApp(title='Smartport BT')
-# config = {<uuid>:{type:<>, name:<>, sensor1:{name:<>,sensor_id:<>,data_id:<>,index:<>,unit:<>,alarm:<>,condition:<>...}
-#          settings:{bt{name:<>,address:<>}}}
-# telemetry = {<sensorId>: {<dataId>: {<index>: <value>, <index>: <value>}}}
-telemetry = {}
-telemetry['sensor_id'] = 0
-bt = {
-    'name': '',
-    'address': '',
-    'type': ''
-}
+# config = {<uuid>:{type:<>, name:<>, sensor1:{name:<>,sensor_id:<>,data_id:<>,index:<>,unit:<>,device:<>,alarm:<>,condition:<>...}
+#          settings:{devices:[{name:<>,address:<>,type:<>}]}}
 settings = {
-    'bt': bt
+    'devices': []
 }
 sensor = {
     'name': '',
@@ -792,12 +949,16 @@ sensor = {
     'data_id': 0,
     'index': 0,
     'unit': '',
+    'device': '',
     'multiplier': 1,
     'alarm': False,
     'alarm_condition': '',
     'alarm_interval': 0,
     'alarm_value': 0,
-    'alarm_text': ''
+    'alarm_hysteresis': 0.0,
+    'alarm_debounce': 0.0,
+    'alarm_text': '',
+    'callout': 0
 }
 monitor = {
     'type': 'monitor',
@@ -808,12 +969,16 @@ monitor = {
         'data_id': 0,
         'index': 0,
         'unit': '',
+        'device': '',
         'multiplier': 1.0,
         'alarm': False,
         'alarm_condition': 'lower',
         'alarm_interval': 0,
         'alarm_value': 0,
-        'alarm_text': ''
+        'alarm_hysteresis': 0.0,
+        'alarm_debounce': 0.0,
+        'alarm_text': '',
+        'callout': 0
     },
     'sensor2': {
         'name': '',
@@ -821,12 +986,16 @@ monitor = {
         'data_id': 0,
         'index': 0,
         'unit': '',
+        'device': '',
         'multiplier': 1.0,
         'alarm': False,
         'alarm_condition': 'lower',
         'alarm_interval': 0,
         'alarm_value': 0,
-        'alarm_text': ''
+        'alarm_hysteresis': 0.0,
+        'alarm_debounce': 0.0,
+        'alarm_text': '',
+        'callout': 0
     },
     'sensor3': {
         'name': '',
@@ -834,12 +1003,16 @@ monitor = {
         'data_id': 0,
         'index': 0,
         'unit': '',
+        'device': '',
         'multiplier': 1.0,
         'alarm': False,
         'alarm_condition': 'lower',
         'alarm_interval': 0,
         'alarm_value': 0,
-        'alarm_text': ''
+        'alarm_hysteresis': 0.0,
+        'alarm_debounce': 0.0,
+        'alarm_text': '',
+        'callout': 0
     },
     'sensor4': {
         'name': '',
@@ -847,12 +1020,16 @@ monitor = {
         'data_id': 0,
         'index': 0,
         'unit': '',
+        'device': '',
         'multiplier': 1.0,
         'alarm': False,
         'alarm_condition': 'lower',
         'alarm_interval': 0,
         'alarm_value': 0,
-        'alarm_text': ''
+        'alarm_hysteresis': 0.0,
+        'alarm_debounce': 0.0,
+        'alarm_text': '',
+        'callout': 0
     },
     'sensor5': {
         'name': '',
@@ -860,12 +1037,16 @@ monitor = {
         'data_id': 0,
         'index': 0,
         'unit': '',
+        'device': '',
         'multiplier': 1.0,
         'alarm': False,
         'alarm_condition': 'lower',
         'alarm_interval': 0,
         'alarm_value': 0,
-        'alarm_text': ''
+        'alarm_hysteresis': 0.0,
+        'alarm_debounce': 0.0,
+        'alarm_text': '',
+        'callout': 0
     },
     'sensor6': {
         'name': '',
@@ -873,52 +1054,88 @@ monitor = {
         'data_id': 0,
         'index': 0,
         'unit': '',
+        'device': '',
         'multiplier': 1.0,
         'alarm': False,
         'alarm_condition': 'lower',
         'alarm_interval': 0,
         'alarm_value': 0,
-        'alarm_text': ''
+        'alarm_hysteresis': 0.0,
+        'alarm_debounce': 0.0,
+        'alarm_text': '',
+        'callout': 0
     }
 }
 config = {
     'settings': settings
 }
 
-screen_manager = ScreenManager()
+screen_manager = LazyScreenManager()
+screen_manager.factories = {
+    'screen_settings': ScreenSettings,
+    'screen_edit_name': ScreenEditName,
+    'screen_edit_sensor': ScreenEditSensor,
+    'screen_monitor': ScreenMonitor,
+    'screen_list': ScreenList,
+    'screen_diagnostics': ScreenDiagnostics,
+}
 screen_monitors = ScreenMonitors(name='screen_monitors')
-screen_settings = ScreenSettings(name='screen_settings')
-screen_edit_name = ScreenEditName(name='screen_edit_name')
-screen_edit_sensor = ScreenEditSensor(name='screen_edit_sensor')
-screen_monitor = ScreenMonitor(name='screen_monitor')
-screen_list = ScreenList(name='screen_list')
+screen_settings = LazyScreen('screen_settings')
+screen_edit_name = LazyScreen('screen_edit_name')
+screen_edit_sensor = LazyScreen('screen_edit_sensor')
+screen_monitor = LazyScreen('screen_monitor')
+screen_list = LazyScreen('screen_list')
+screen_diagnostics = LazyScreen('screen_diagnostics')
 screen_manager.add_widget(screen_monitors)
-screen_manager.add_widget(screen_settings)
-screen_manager.add_widget(screen_edit_name)
-screen_manager.add_widget(screen_edit_sensor)
-screen_manager.add_widget(screen_list)
-screen_manager.add_widget(screen_monitor)
 screen_manager.current = 'screen_monitors'
+startup_timings.append(('screens', time.perf_counter()))
 
-store = JsonStore('smartportbt.json')
+store = ConfigStore('smartportbt.json')
 for element in store.keys():
     config[element] = store[element]
-    if 'type' in config[element]:
-        if config[element]['type'] == 'monitor':
-            button = Factory.ButtonList(text=config[element]['name'])
-            button.uuid = element
-            button.bind(on_long_press=screen_monitors.show_popup_monitors)
-            button.bind(on_short_press=screen_monitors.show_screen_monitor)
-            screen_monitors.ids.list_config.add_widget(button)
+screen_monitors.ids.list_config.data = [screen_monitors.monitor_item(element) for element in store.keys()
+                                        if config[element].get('type') == 'monitor']
+if 'devices' not in config['settings']:
+    # settings from before multiple devices had a single bt device
+    bt = config['settings'].pop('bt', {})
+    config['settings']['devices'] = [bt] if bt.get('type') else []
+# tiles from before multiple devices read the first one
+for element in config.values():
+    if element.get('type') == 'monitor' and config['settings']['devices']:
+        for cont in range(1, 7):
+            element['sensor' + str(cont)].setdefault('device', device_key(config['settings']['devices'][0]))
+startup_timings.append(('monitor_list', time.perf_counter()))
+telemetry.history = config['settings'].get('history', HISTORY)
+alarm_engine = AlarmEngine(speak_alarm)
+compile_alarms()
 
 bluetooth_extended = BluetoothExtended()
-bluetooth_extended.timeout = 0.003
-
-event_voice = threading.Event()
-thread_voice = threading.Thread(
-    name='thread_voice', target=do_speak, args=(event_voice,), daemon=True)
-thread_voice.start()
-packet = []
+device_scanner = DeviceScanner(bluetooth_extended)
+
+speech = SpeechQueue()
+speech.start()
+
+UPDATE_SECONDS = metrics.histogram(
+    'smartport_ui_update_seconds', 'Monitor refresh time', (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05))
+metrics.gauge('smartport_bytes_total', 'Bytes received',
+              partial(connections_total, 'link_stats', 'bytes'), 'counter')
+metrics.gauge('smartport_frames_total', 'Frames with a valid CRC',
+              partial(connections_total, 'decoder', 'frames'), 'counter')
+metrics.gauge('smartport_crc_errors_total', 'Frames rejected by the CRC',
+              partial(connections_total, 'decoder', 'crc_errors'), 'counter')
+metrics.gauge('smartport_resyncs_total', 'Incomplete frames dropped at a start byte',
+              partial(connections_total, 'decoder', 'resyncs'), 'counter')
+metrics.gauge('smartport_reconnects_total', 'Automatic reconnects',
+              partial(connections_total, 'link_stats', 'reconnects'), 'counter')
+metrics.gauge('smartport_log_dropped_total', 'Frames dropped by the telemetry log',
+              partial(connections_total, 'logger', 'dropped'), 'counter')
+metrics.gauge('smartport_server_clients', 'Clients of the telemetry server',
+              lambda: len(telemetry_server.subscribers) if telemetry_server else None)
+metrics.gauge('smartport_server_dropped_total', 'Slow clients dropped by the telemetry server',
+              lambda: telemetry_server.dropped if telemetry_server else None, 'counter')
+metrics.gauge('smartport_speech_dropped_total', 'Announcements expired before spoken',
+              lambda: speech.dropped, 'counter')
+startup_timings.append(('services', time.perf_counter()))
 
 if __name__ == "__main__":
     smartport_app.run()
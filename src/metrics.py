@@ -0,0 +1,177 @@
+"""
+           Metrics
+
+ Counters and histograms of the link and decode pipeline, dumped as json
+ or Prometheus text. Metrics have no lock, readers may see a value one
+ update old and reader threads of simultaneous connections may rarely
+ lose an increment
+
+"""
+
+import bisect
+import json
+import time
+from array import array
+
+
+class Counter():
+
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def samples(self):
+        return [((), self.value)]
+
+
+class CounterArray():
+
+    # One counter per small integer key, preallocated so the hot path only
+    # indexes the array. Keys never counted are left out of the dump
+
+    __slots__ = ('name', 'help', 'label', 'values')
+
+    def __init__(self, name, help, label, size):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = array('Q', bytes(8 * size))
+
+    def samples(self):
+        return [(((self.label, '{:#x}'.format(key)),), value)
+                for key, value in enumerate(self.values) if value]
+
+
+class CounterMap():
+
+    # Counters for sparse keys such as data_ids, created on first use
+
+    __slots__ = ('name', 'help', 'label', 'values')
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, key):
+        self.values[key] = self.values.get(key, 0) + 1
+
+    def samples(self):
+        return [(((self.label, '{:#x}'.format(key)),), value)
+                for key, value in sorted(self.values.items())]
+
+
+class Gauge():
+
+    # Value read from a function at dump time, for values and counters
+    # kept elsewhere
+
+    __slots__ = ('name', 'help', 'function', 'kind')
+
+    def __init__(self, name, help, function, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        value = self.function()
+        return [] if value is None else [((), value)]
+
+
+class Histogram():
+
+    # Cumulative only at dump time, observe() increments one bucket
+
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, name, help, bounds):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        self.counts = array('Q', bytes(8 * (len(bounds) + 1)))
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            samples.append(((('le', str(bound)),), total))
+        return samples
+
+
+class MetricsRegistry():
+
+    def __init__(self):
+        self.metrics = {}
+        self.start = time.time()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def counter_array(self, name, help, label, size):
+        return self.register(CounterArray(name, help, label, size))
+
+    def counter_map(self, name, help, label):
+        return self.register(CounterMap(name, help, label))
+
+    def gauge(self, name, help, function, kind='gauge'):
+        return self.register(Gauge(name, help, function, kind))
+
+    def histogram(self, name, help, bounds):
+        return self.register(Histogram(name, help, bounds))
+
+    def snapshot(self):
+        # {name: value} for plain metrics, {label value: value} for keyed
+        # ones and {'buckets', 'sum', 'count'} for histograms
+        snapshot = {'uptime': time.time() - self.start}
+        for name, metric in list(self.metrics.items()):
+            samples = metric.samples()
+            if isinstance(metric, Histogram):
+                snapshot[name] = {'buckets': {labels[0][1]: value for labels, value in samples},
+                                  'sum': metric.sum, 'count': metric.count}
+            elif isinstance(metric, (CounterArray, CounterMap)):
+                snapshot[name] = {labels[0][1]: value for labels, value in samples}
+            elif samples:
+                snapshot[name] = samples[0][1]
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1)
+
+    def to_prometheus(self):
+        lines = []
+        for name, metric in list(self.metrics.items()):
+            kind = 'counter'
+            if isinstance(metric, Gauge):
+                kind = metric.kind
+            elif isinstance(metric, Histogram):
+                kind = 'histogram'
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            sample_name = name + '_bucket' if kind == 'histogram' else name
+            for labels, value in metric.samples():
+                label_text = ','.join('{}="{}"'.format(key, label) for key, label in labels)
+                lines.append('{}{} {}'.format(sample_name, '{' + label_text + '}' if labels else '', value))
+            if kind == 'histogram':
+                lines.append('{}_sum {}'.format(name, metric.sum))
+                lines.append('{}_count {}'.format(name, metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,170 @@
+"""
+           Time series
+
+ Fixed memory history of a telemetry slot with rolling window stats and
+ downsampled levels for plotting
+
+"""
+
+from array import array
+from collections import deque
+
+
+class Window():
+
+    # Rolling min, max and mean over the last seconds. Amortized O(1) per
+    # sample: expired samples are read back from the series ring and the
+    # min/max candidates are kept in monotonic deques
+
+    def __init__(self, series, seconds):
+        self.series = series
+        self.seconds = seconds
+        self.first = 0
+        self.sum = 0.0
+        self.mins = deque()
+        self.maxs = deque()
+
+    def append(self, position, timestamp, value):
+        # called before the sample is written to the ring, so the one it
+        # overwrites can still be read back
+        series = self.series
+        values = series.values
+        capacity = series.capacity
+        # samples older than the window or about to be overwritten
+        times = series.times
+        start = timestamp - self.seconds
+        first = self.first
+        oldest = position - capacity + 1
+        while first < position and (first < oldest or times[first % capacity] < start):
+            self.sum -= values[first % capacity]
+            first += 1
+        self.first = first
+        mins = self.mins
+        while mins and mins[0] < first:
+            mins.popleft()
+        while mins and values[mins[-1] % capacity] >= value:
+            mins.pop()
+        mins.append(position)
+        maxs = self.maxs
+        while maxs and maxs[0] < first:
+            maxs.popleft()
+        while maxs and values[maxs[-1] % capacity] <= value:
+            maxs.pop()
+        maxs.append(position)
+        self.sum += value
+
+    def stats(self):
+        # (min, max, mean), None if empty
+        count = self.series.count - self.first
+        if count <= 0:
+            return None
+        return (self.series.value(self.mins[0]), self.series.value(self.maxs[0]),
+                self.sum / count)
+
+
+class Level():
+
+    # Ring of buckets, each the min, max and mean of factor samples of the
+    # level below
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.mins = array('d', bytes(8 * capacity))
+        self.maxs = array('d', bytes(8 * capacity))
+        self.means = array('d', bytes(8 * capacity))
+        self.count = 0
+        self.reset()
+
+    def reset(self):
+        self.pending = 0
+        self.pending_time = 0.0
+        self.pending_min = 0.0
+        self.pending_max = 0.0
+        self.pending_sum = 0.0
+
+    def add(self, timestamp, low, high, mean, factor):
+        # returns True when a bucket is complete
+        if self.pending == 0:
+            self.pending_time = timestamp
+            self.pending_min = low
+            self.pending_max = high
+        else:
+            if low < self.pending_min:
+                self.pending_min = low
+            if high > self.pending_max:
+                self.pending_max = high
+        self.pending_sum += mean
+        self.pending += 1
+        if self.pending < factor:
+            return False
+        i = self.count % self.capacity
+        self.times[i] = self.pending_time
+        self.mins[i] = self.pending_min
+        self.maxs[i] = self.pending_max
+        self.means[i] = self.pending_sum / self.pending
+        self.count += 1
+        self.reset()
+        return True
+
+
+class SeriesBuffer():
+
+    # capacity samples of raw history plus levels of buckets of factor,
+    # factor ** 2... samples, each level with the same capacity
+
+    def __init__(self, capacity=1024, windows=(10, 60), levels=3, factor=8):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.count = 0
+        self.factor = factor
+        self.windows = {seconds: Window(self, seconds) for seconds in windows}
+        self.levels = [Level(capacity) for _ in range(levels)]
+
+    def time(self, position):
+        return self.times[position % self.capacity]
+
+    def value(self, position):
+        return self.values[position % self.capacity]
+
+    def append(self, timestamp, value):
+        position = self.count
+        for window in self.windows.values():
+            window.append(position, timestamp, value)
+        i = position % self.capacity
+        self.times[i] = timestamp
+        self.values[i] = value
+        self.count += 1
+        low = high = mean = value
+        for level in self.levels:
+            if not level.add(timestamp, low, high, mean, self.factor):
+                break
+            j = (level.count - 1) % level.capacity
+            low, high, mean = level.mins[j], level.maxs[j], level.means[j]
+
+    def stats(self, seconds):
+        # (min, max, mean) over one of the configured windows
+        return self.windows[seconds].stats()
+
+    def points(self, max_points, seconds=None):
+        # times and values of at most max_points samples covering the last
+        # seconds, from the finest level that fits. Buckets give their mean
+        if not self.count:
+            return [], []
+        start = self.time(self.count - 1) - seconds if seconds else None
+        sources = [(self.times, self.values, self.count, self.capacity)]
+        sources += [(level.times, level.means, level.count, level.capacity)
+                    for level in self.levels if level.count]
+        for times, values, count, capacity in sources:
+            available = min(count, capacity)
+            n = 0
+            while n < available and n <= max_points:
+                if start is not None and times[(count - 1 - n) % capacity] < start:
+                    break
+                n += 1
+            if n <= max_points:
+                break
+        n = min(n, max_points)
+        positions = [(count - n + k) % capacity for k in range(n)]
+        return [times[i] for i in positions], [values[i] for i in positions]
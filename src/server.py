@@ -0,0 +1,371 @@
+#!/usr/bin/python3
+
+"""
+           Telemetry server
+
+ Publishes the decoded frames, and optionally the raw bytes, to TCP and
+ WebSocket clients on the local network. Clients get one json line or
+ text message per frame and can send a json filter at any time:
+
+ {"sensor_id": [27], "data_id": ["0x0300", "0x0b50"], "raw": false}
+
+ python3 server.py --rate 100 --port 5760 --ws-port 5761
+
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import struct
+import threading
+import time
+from collections import deque
+from smartport import frame_values
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+INBOX_SIZE = 65536
+# frames fanned out before the clients get to write
+DISPATCH_BATCH = 64
+# longest filter accepted from a client, longer ones close it
+MESSAGE_SIZE = 65536
+
+
+def parse_ids(values):
+    # set of ids from ints or '0x' strings, None for all
+    if not values:
+        return None
+    return set(value if isinstance(value, int) else int(value, 0) for value in values)
+
+
+def ws_frame(payload, opcode=0x1):
+    size = len(payload)
+    if size < 126:
+        header = struct.pack('!BB', 0x80 | opcode, size)
+    elif size < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, size)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, size)
+    return header + payload
+
+
+class Subscriber():
+
+    # A connected client with its filter and bounded queue. When the queue
+    # is full a slow client is disconnected with the 'drop' policy, with
+    # 'downsample' it keeps only the latest frame of each sensor until it
+    # catches up
+
+    def __init__(self, writer, websocket, queue_size, policy):
+        self.writer = writer
+        self.websocket = websocket
+        self.queue_size = queue_size
+        self.policy = policy
+        self.sensor_ids = None
+        self.data_ids = None
+        self.raw = False
+        self.queue = deque()
+        self.latest = {}
+        self.event = asyncio.Event()
+        self.sent = 0
+        self.downsampled = 0
+        self.closed = False
+
+    def accepts(self, sensor_id, data_id):
+        return ((self.sensor_ids is None or sensor_id in self.sensor_ids) and
+                (self.data_ids is None or data_id in self.data_ids))
+
+    def set_filter(self, text):
+        try:
+            options = json.loads(text)
+            self.sensor_ids = parse_ids(options.get('sensor_id'))
+            self.data_ids = parse_ids(options.get('data_id'))
+            self.raw = bool(options.get('raw', False))
+        except (ValueError, TypeError, AttributeError) as error:
+            logging.info('Invalid filter: {}'.format(error))
+
+    def put(self, key, message):
+        # False when the client has to be dropped
+        if len(self.queue) < self.queue_size and not self.latest:
+            self.queue.append(message)
+        elif self.policy == 'downsample':
+            if key in self.latest:
+                self.downsampled += 1
+            self.latest[key] = message
+        else:
+            return False
+        self.event.set()
+        return True
+
+    def take(self):
+        messages = list(self.queue)
+        self.queue.clear()
+        if self.latest:
+            messages += self.latest.values()
+            self.latest = {}
+        self.sent += len(messages)
+        if self.websocket:
+            return b''.join([ws_frame(message) for message in messages])
+        return b''.join(messages)
+
+
+class TelemetryServer():
+
+    # Runs an asyncio loop in its own thread. publish() and publish_raw()
+    # are called from the reader threads and only append to the inbox, the
+    # loop encodes each frame once and fans it out to the subscribers, so
+    # clients never slow the decoder down. ws_port None disables WebSocket
+
+    def __init__(self, host='0.0.0.0', port=5760, ws_port=None, queue_size=256, policy='downsample'):
+        self.host = host
+        self.port = port
+        self.ws_port = ws_port
+        self.queue_size = queue_size
+        self.policy = policy
+        self.inbox = deque(maxlen=INBOX_SIZE)
+        self.scheduled = False
+        self.stopped = False
+        self.subscribers = set()
+        self.offset = time.time() - time.monotonic()
+        self.loop = None
+        self.servers = []
+        self.thread = None
+        self.event_started = threading.Event()
+        self.error = None
+        self.published = 0
+        self.dropped = 0
+
+    def start(self):
+        # raises OSError when a port can't be opened
+        self.scheduled = False
+        self.stopped = False
+        self.thread = threading.Thread(name='thread_server', target=self.run, daemon=True)
+        self.thread.start()
+        self.event_started.wait()
+        if self.error:
+            raise self.error
+
+    def stop(self):
+        if self.loop and self.thread:
+            self.stopped = True
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.servers.append(self.loop.run_until_complete(
+                asyncio.start_server(self.serve_tcp, self.host, self.port, limit=MESSAGE_SIZE)))
+            if self.ws_port is not None:
+                self.servers.append(self.loop.run_until_complete(
+                    asyncio.start_server(self.serve_websocket, self.host, self.ws_port, limit=MESSAGE_SIZE)))
+        except OSError as error:
+            self.error = error
+            self.event_started.set()
+            self.loop.close()
+            return
+        # port 0 picks a free port
+        self.port = self.servers[0].sockets[0].getsockname()[1]
+        if self.ws_port is not None:
+            self.ws_port = self.servers[1].sockets[0].getsockname()[1]
+        self.event_started.set()
+        self.loop.run_forever()
+        for server in self.servers:
+            server.close()
+        for subscriber in list(self.subscribers):
+            self.close(subscriber)
+        tasks = asyncio.all_tasks(self.loop)
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+        self.loop.close()
+        self.servers = []
+
+    def publish(self, timestamp, frame, device=''):
+        # called from the reader threads
+        self.inbox.append((timestamp, frame, device, None))
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self.dispatch)
+
+    def publish_raw(self, timestamp, buffer, device=''):
+        # called from the reader threads
+        self.inbox.append((timestamp, None, device, bytes(buffer)))
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self.dispatch)
+
+    def dispatch(self):
+        inbox = self.inbox
+        subscribers = self.subscribers
+        for _ in range(DISPATCH_BATCH):
+            if not inbox:
+                break
+            timestamp, frame, device, raw = inbox.popleft()
+            self.published += 1
+            if not subscribers:
+                continue
+            t = round(timestamp + self.offset, 4)
+            message = None
+            if raw is not None:
+                for subscriber in list(subscribers):
+                    if subscriber.raw:
+                        if message is None:
+                            message = (json.dumps({'t': t, 'device': device, 'bytes': raw.hex()}) + '\n').encode()
+                        self.deliver(subscriber, (device, None), message)
+                continue
+            sensor_id, frame_id, data_id, value = frame
+            for subscriber in list(subscribers):
+                if not subscriber.accepts(sensor_id, data_id):
+                    continue
+                if message is None:
+                    message = (json.dumps({'t': t, 'device': device, 'sensor_id': sensor_id,
+                                           'data_id': data_id, 'raw': value,
+                                           'values': frame_values(frame)}) + '\n').encode()
+                self.deliver(subscriber, (device, sensor_id, data_id), message)
+        if inbox:
+            self.loop.call_soon(self.dispatch)
+            return
+        # stays set once stopped so publish() won't schedule on the closed loop
+        self.scheduled = self.stopped
+        if inbox and not self.scheduled:
+            # published after the inbox was seen empty
+            self.scheduled = True
+            self.loop.call_soon(self.dispatch)
+
+    def deliver(self, subscriber, key, message):
+        if not subscriber.put(key, message):
+            self.dropped += 1
+            self.close(subscriber)
+
+    def close(self, subscriber):
+        if not subscriber.closed:
+            subscriber.closed = True
+            self.subscribers.discard(subscriber)
+            subscriber.event.set()
+            # without waiting for a slow client to take the buffered data
+            subscriber.writer.transport.abort()
+
+    async def send(self, subscriber):
+        writer = subscriber.writer
+        try:
+            while not subscriber.closed:
+                await subscriber.event.wait()
+                subscriber.event.clear()
+                if subscriber.closed:
+                    break
+                writer.write(subscriber.take())
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        self.close(subscriber)
+
+    async def serve_tcp(self, reader, writer):
+        subscriber = Subscriber(writer, False, self.queue_size, self.policy)
+        self.subscribers.add(subscriber)
+        sender = asyncio.ensure_future(self.send(subscriber))
+        try:
+            while not subscriber.closed:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    subscriber.set_filter(line.decode(errors='replace'))
+        except (ValueError, asyncio.LimitOverrunError, ConnectionError, OSError):
+            # a line over the stream limit raises ValueError
+            pass
+        self.close(subscriber)
+        await sender
+
+    async def serve_websocket(self, reader, writer):
+        try:
+            key = None
+            while True:
+                line = await reader.readline()
+                if not line or line in (b'\r\n', b'\n'):
+                    break
+                name, _, value = line.decode(errors='replace').partition(':')
+                if name.strip().lower() == 'sec-websocket-key':
+                    key = value.strip().encode()
+            if key is None:
+                writer.write(b'HTTP/1.1 400 Bad Request\r\n\r\n')
+                writer.close()
+                return
+            accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+            writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                         b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        except (ValueError, asyncio.LimitOverrunError, ConnectionError, OSError):
+            writer.close()
+            return
+        subscriber = Subscriber(writer, True, self.queue_size, self.policy)
+        self.subscribers.add(subscriber)
+        sender = asyncio.ensure_future(self.send(subscriber))
+        try:
+            while not subscriber.closed:
+                head = await reader.readexactly(2)
+                opcode = head[0] & 0x0F
+                size = head[1] & 0x7F
+                if size == 126:
+                    size = struct.unpack('!H', await reader.readexactly(2))[0]
+                elif size == 127:
+                    size = struct.unpack('!Q', await reader.readexactly(8))[0]
+                if size > MESSAGE_SIZE:
+                    # message too big
+                    writer.write(ws_frame(struct.pack('!H', 1009), 0x8))
+                    break
+                mask = await reader.readexactly(4) if head[1] & 0x80 else b'\0\0\0\0'
+                payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(await reader.readexactly(size)))
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    writer.write(ws_frame(payload, 0xA))
+                elif opcode == 0x1:
+                    subscriber.set_filter(payload.decode(errors='replace'))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        self.close(subscriber)
+        await sender
+
+
+def main():
+    from simulator import SimulatedHub
+    from smartport import SmartportDecoder
+    parser = argparse.ArgumentParser(description='Telemetry server fed by the sensor hub simulator')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5760, help='json lines over TCP')
+    parser.add_argument('--ws-port', type=int, default=5761, help='WebSocket')
+    parser.add_argument('--rate', type=int, default=100, help='simulator frames per second')
+    parser.add_argument('--policy', default='downsample', choices=('downsample', 'drop'),
+                        help='slow client handling')
+    parser.add_argument('--raw', action='store_true', help='publish the raw bytes too')
+    args = parser.parse_args()
+    server = TelemetryServer(args.host, args.port, args.ws_port, policy=args.policy)
+    try:
+        server.start()
+    except OSError as error:
+        parser.exit(1, 'Couldn\'t start server: {}\n'.format(error))
+    hub = SimulatedHub(rate=args.rate)
+    hub.connect('', 'simulator')
+    decoder = SmartportDecoder()
+    try:
+        while True:
+            buffer = hub.read(256)
+            timestamp = time.monotonic()
+            if args.raw and buffer:
+                server.publish_raw(timestamp, buffer, 'simulator')
+            for frame in decoder.feed(buffer):
+                if frame[1] == 0x10:
+                    server.publish(timestamp, frame, 'simulator')
+            if not buffer:
+                time.sleep(0.005)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
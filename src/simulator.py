@@ -0,0 +1,133 @@
+"""
+           Smartport sensor hub simulator
+
+ Transport with the BluetoothExtended interface that produces stuffed,
+ CRC'd frames from simulated sensors
+
+"""
+
+import math
+import random
+import time
+from smartport import encode_frame, get_sensor_data, START_BYTE
+
+# physical sensor ids as polled by the receiver
+PHYSICAL_IDS = (0x00, 0xA1, 0x22, 0x83, 0xE4, 0x45, 0xC6, 0x67, 0x48, 0xE9, 0x6A, 0xCB, 0xAC, 0x0D,
+                0x8E, 0x2F, 0xD0, 0x71, 0xF2, 0x53, 0x34, 0x95, 0x16, 0xB7, 0x98, 0x39, 0xBA, 0x1B)
+
+
+def lipo_cells(count):
+    # one generator per cell pair frame, value in 2 mV units sagging with time
+    def generator(t, rng, pair):
+        first = pair * 2
+        volts = [2100 - int(50 * (1 + math.sin(t / 7))) - rng.randrange(5) for _ in range(2)]
+        return count << 4 | first | volts[0] << 8 | volts[1] << 20
+    generator.pairs = (count + 1) // 2
+    return generator
+
+
+def wave(low, high, period):
+    def generator(t, rng, pair):
+        return int(low + (high - low) * (1 + math.sin(2 * math.pi * t / period)) / 2)
+    return generator
+
+
+def pair(low, high):
+    # 16 bit values in the low and high half
+    def generator(t, rng, index):
+        return low(t, rng, index) | high(t, rng, index) << 16
+    return generator
+
+
+# (physical id, data_id, generator)
+PROFILES = {
+    'lipo': [(0x1B, 0x0300, lipo_cells(6)),
+             (0x1B, 0x0210, wave(2100, 2520, 60))],
+    'esc': [(0x22, 0x0b50, pair(wave(2100, 2520, 60), wave(0, 6000, 10))),
+            (0x22, 0x0b60, pair(wave(0, 300, 10), wave(0, 2200, 600))),
+            (0x22, 0x0200, wave(0, 600, 10))],
+    'gps': [(0x83, 0x0800, wave(0, 0xFFFFFFFF, 300)),
+            (0x83, 0x0820, wave(0, 12000, 120)),
+            (0x83, 0x0830, wave(0, 40000, 30)),
+            (0x83, 0x0840, wave(0, 35999, 90))],
+    'vario': [(0x00, 0x0100, wave(0, 12000, 120)),
+              (0x00, 0x0110, wave(0, 500, 20))],
+    'rx': [(0x98, 0xf101, wave(40, 100, 45)),
+           (0x98, 0xf104, wave(45, 55, 60))],
+}
+
+
+class SimulatedHub():
+
+    # rate: frames per second, 0 fills every read
+    # noise: probability of a corrupted byte
+    # drop: probability of a dropped byte
+    # burst: average frames per read, reads are spread around it
+
+    def __init__(self, sensors=None, profiles=('lipo', 'esc', 'gps', 'rx'), rate=100,
+                 noise=0.0, drop=0.0, burst=1, seed=None):
+        self.isConnected = False
+        self.type = 'simulator'
+        self.sensors = []
+        for profile in profiles:
+            self.sensors += PROFILES[profile]
+        if sensors:
+            self.sensors += sensors
+        for sensor_id, data_id, generator in self.sensors:
+            if sensor_id not in PHYSICAL_IDS or get_sensor_data(data_id) is None:
+                raise ValueError('Unknown sensor {:#04x} {:#06x}'.format(sensor_id, data_id))
+        self.rate = rate
+        self.noise = noise
+        self.drop = drop
+        self.burst = burst
+        self.random = random.Random(seed)
+        self.frames = 0
+
+    def connect(self, address, type):
+        self.start = time.monotonic()
+        self.first = self.frames
+        self.pending = bytearray()
+        self.next = 0
+        self.cells = {}
+        self.isConnected = True
+
+    def disconnect(self):
+        self.isConnected = False
+
+    def frame(self, t):
+        # next frame in round robin order, cell sensors send one pair per frame
+        sensor_id, data_id, generator = self.sensors[self.next % len(self.sensors)]
+        self.next += 1
+        index = 0
+        if 2 in get_sensor_data(data_id):
+            index = self.cells.get(data_id, 0)
+            self.cells[data_id] = (index + 1) % getattr(generator, 'pairs', 1)
+        self.frames += 1
+        return encode_frame(sensor_id, data_id, generator(t, self.random, index))
+
+    def read(self, lenght):
+        rng = self.random
+        now = time.monotonic()
+        t = now - self.start
+        count = max(1, int(rng.expovariate(1 / self.burst))) if self.burst > 1 else 1
+        if not self.rate:
+            count = lenght
+        else:
+            due = self.frames - self.first + count - t * self.rate
+            if due > 0:
+                time.sleep(due / self.rate)
+                t = time.monotonic() - self.start
+        while len(self.pending) < lenght and count > 0:
+            self.pending += self.frame(t)
+            # poll of an absent sensor
+            self.pending += bytes((START_BYTE, rng.choice(PHYSICAL_IDS)))
+            count -= 1
+        data = self.pending[:lenght]
+        del self.pending[:lenght]
+        if self.noise or self.drop:
+            for i in range(len(data) - 1, -1, -1):
+                if rng.random() < self.drop:
+                    del data[i]
+                elif rng.random() < self.noise:
+                    data[i] = rng.randrange(256)
+        return bytes(data)
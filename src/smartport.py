@@ -0,0 +1,267 @@
+"""
+           Smartport protocol
+
+ Sensor definitions and frame decoding shared by the app and tools
+
+"""
+
+import bisect
+import json
+import struct
+
+START_BYTE = 0x7E
+ESCAPE_BYTE = 0x7D
+FRAME_SIZE = 10
+# sensor_id, frame_id, data_id, value
+FRAME_STRUCT = struct.Struct('<BBHI')
+
+# (first data_id, last data_id, {index: definition})
+# index 0 - low 16 bits, 1 - high 16 bits, 2 - cell pair
+SENSORS = [
+    (0x0100, 0x010e, {0: {'name': 'Alt', 'unit': 'm', 'mult': 1, 'shift': 0}}),
+    (0x0110, 0x011e, {0: {'name': 'Vario', 'unit': 'm/s', 'mult': 1, 'shift': 0.01}}),
+    (0x0200, 0x020e, {0: {'name': 'Curr', 'unit': 'A', 'mult': 0.1, 'shift': 0}}),
+    (0x0210, 0x021e, {0: {'name': 'VFAS', 'unit': 'v', 'mult': 0.01, 'shift': 0}}),
+    (0x0300, 0x030e, {2: {'name': 'Cell', 'unit': 'v', 'mult': 0.002, 'shift': 0}}),
+    (0x0400, 0x040e, {0: {'name': 'Temp1', 'unit': 'C', 'mult': 1, 'shift': 0}}),
+    (0x0410, 0x041e, {0: {'name': 'Temp2', 'unit': 'C', 'mult': 1, 'shift': 0}}),
+    (0x0500, 0x050e, {0: {'name': 'Rpm', 'unit': 'rpm', 'mult': 1, 'shift': 0}}),
+    (0x0600, 0x060e, {0: {'name': 'Fuel', 'unit': '%', 'mult': 0.01, 'shift': 0}}),
+    (0x0700, 0x070e, {0: {'name': 'AccX', 'unit': 'g', 'mult': 0.01, 'shift': 0}}),
+    (0x0710, 0x071e, {0: {'name': 'AccY', 'unit': 'g', 'mult': 0.01, 'shift': 0}}),
+    (0x0720, 0x072e, {0: {'name': 'AccZ', 'unit': 'g', 'mult': 0.01, 'shift': 0}}),
+    (0x0800, 0x080e, {0: {'name': 'GPSLong', 'unit': '', 'mult': 0.01, 'shift': 0},
+                      1: {'name': 'GPSLat', 'unit': '', 'mult': 0.01, 'shift': 16}}),
+    (0x0820, 0x082e, {0: {'name': 'GPSAlt', 'unit': 'm', 'mult': 0.01, 'shift': 0}}),
+    (0x0830, 0x083e, {0: {'name': 'GPSSpeed', 'unit': 'kts', 'mult': 0.001, 'shift': 0}}),
+    (0x0840, 0x084e, {0: {'name': 'GPSCours', 'unit': '\xf8', 'mult': 0.01, 'shift': 0}}),
+    (0x0850, 0x085e, {0: {'name': 'GPSTime', 'unit': 'g', 'mult': 0.01, 'shift': 0}}),
+    (0x0900, 0x090e, {0: {'name': 'A3', 'unit': 'v', 'mult': 0.01, 'shift': 0}}),
+    (0x0910, 0x091e, {0: {'name': 'A4', 'unit': 'v', 'mult': 0.01, 'shift': 0}}),
+    (0x0a00, 0x0a0e, {0: {'name': 'AirSpeed', 'unit': 'kts', 'mult': 0.01, 'shift': 0}}),
+    (0x0a10, 0x0a1e, {0: {'name': 'FuelQty', 'unit': 'ml', 'mult': 0.01, 'shift': 0}}),
+    (0x0b00, 0x0b0e, {0: {'name': 'RboxBatt1', 'unit': 'v', 'mult': 0.001, 'shift': 0}}),
+    (0x0b10, 0x0b1e, {0: {'name': 'RboxBatt2', 'unit': 'v', 'mult': 0.001, 'shift': 0}}),
+    (0x0b20, 0x0b2e, {0: {'name': 'RboxState', 'unit': '', 'mult': 0.01, 'shift': 0}}),
+    (0x0b30, 0x0b3e, {0: {'name': 'RboxCons', 'unit': 'mAh', 'mult': 1, 'shift': 0}}),
+    (0x0b50, 0x0b5e, {0: {'name': 'EscV', 'unit': 'v', 'mult': 0.01, 'shift': 0},
+                      1: {'name': 'EscA', 'unit': 'A', 'mult': 0.01, 'shift': 16}}),
+    (0x0b60, 0x0b6e, {0: {'name': 'EscRpm', 'unit': 'rpm', 'mult': 100, 'shift': 0},
+                      1: {'name': 'EscCons', 'unit': 'mAh', 'mult': 1, 'shift': 0}}),
+    (0x0d00, 0x0d0e, {0: {'name': 'GassuitT1', 'unit': 'C', 'mult': 1, 'shift': 0}}),
+    (0x0d10, 0x0d1e, {0: {'name': 'GassuitT2', 'unit': 'C', 'mult': 1, 'shift': 0}}),
+    (0x0d20, 0x0d2e, {0: {'name': 'GassuitSpeed', 'unit': 'rpm', 'mult': 1, 'shift': 0}}),
+    (0x0d30, 0x0d3e, {0: {'name': 'GassuitResVol', 'unit': 'ml', 'mult': 1, 'shift': 0}}),
+    (0x0d40, 0x0d4e, {0: {'name': 'GassuitPerc', 'unit': '%', 'mult': 1, 'shift': 0}}),
+    (0x0d50, 0x0d5e, {0: {'name': 'GassuitFlow', 'unit': '%', 'mult': 1, 'shift': 0}}),
+    (0x0d60, 0x0d6e, {0: {'name': 'GassuitMaxFlow', 'unit': '%', 'mult': 1, 'shift': 0}}),
+    (0x0d70, 0x0d7e, {0: {'name': 'GassuitAvgFlow', 'unit': '%', 'mult': 1, 'shift': 0}}),
+    (0x0e50, 0x0e5e, {0: {'name': 'SBecV', 'unit': 'v', 'mult': 0.01, 'shift': 0},
+                      1: {'name': 'SBecA', 'unit': 'A', 'mult': 0.01, 'shift': 16}}),
+    (0xf101, 0xf101, {0: {'name': 'RSSI', 'unit': '', 'mult': 1, 'shift': 0}}),
+    (0xf102, 0xf102, {0: {'name': 'A1', 'unit': 'v', 'mult': 0.1, 'shift': 0}}),
+    (0xf103, 0xf103, {0: {'name': 'A2', 'unit': 'v', 'mult': 0.1, 'shift': 0}}),
+    (0xf104, 0xf104, {0: {'name': 'RXBT', 'unit': 'v', 'mult': 0.1, 'shift': 0}}),
+    (0xf105, 0xf105, {0: {'name': 'RAS', 'unit': '%', 'mult': 1, 'shift': 0}}),
+]
+
+
+class SensorRegistry():
+
+    def __init__(self, sensors=()):
+        self.firsts = []
+        self.ranges = []
+        self.cache = {}
+        for first, last, data in sensors:
+            self.add(first, last, data)
+
+    def add(self, first, last, data):
+        # a new range replaces any range it overlaps
+        if last < first:
+            raise ValueError('Invalid range {:#06x}-{:#06x}'.format(first, last))
+        self.ranges = [item for item in self.ranges
+                       if item[1] < first or item[0] > last]
+        self.ranges.append((first, last, data))
+        self.ranges.sort(key=lambda item: item[0])
+        self.firsts = [item[0] for item in self.ranges]
+        self.cache.clear()
+
+    def get(self, data_id):
+        try:
+            return self.cache[data_id]
+        except KeyError:
+            pass
+        data = None
+        pos = bisect.bisect_right(self.firsts, data_id) - 1
+        if pos >= 0 and data_id <= self.ranges[pos][1]:
+            data = self.ranges[pos][2]
+        self.cache[data_id] = data
+        return data
+
+    def load(self, path):
+        # [{"first": "0x5100", "last": "0x510f",
+        #   "sensors": {"0": {"name": "Custom", "unit": "", "mult": 1, "shift": 0}}}]
+        with open(path) as file:
+            definitions = json.load(file)
+        for definition in definitions:
+            data = {}
+            for index, sensor in definition['sensors'].items():
+                if int(index) not in (0, 1, 2):
+                    raise ValueError('Invalid sensor index ' + str(index))
+                data[int(index)] = {'name': sensor['name'],
+                                    'unit': sensor.get('unit', ''),
+                                    'mult': sensor.get('mult', 1),
+                                    'shift': sensor.get('shift', 0)}
+            self.add(int(str(definition['first']), 0),
+                     int(str(definition.get('last', definition['first'])), 0), data)
+
+
+sensor_registry = SensorRegistry(SENSORS)
+
+
+def get_sensor_data(data_id):
+    return sensor_registry.get(data_id)
+
+
+def frame_values(frame):
+    # [{'index', 'name', 'unit', 'value'}] of a data frame, cell pairs add
+    # the cell number
+    sensor_id, frame_id, data_id, value = frame
+    sensor_data = get_sensor_data(data_id)
+    values = []
+    if not sensor_data:
+        return values
+    for index, definition in sensor_data.items():
+        if index == 0:
+            values.append({'index': 0, 'name': definition['name'], 'unit': definition['unit'],
+                           'value': round((value & 0x0000FFFF) * definition['mult'], 4)})
+        elif index == 1:
+            values.append({'index': 1, 'name': definition['name'], 'unit': definition['unit'],
+                           'value': round((value >> 16) * definition['mult'], 4)})
+        else:
+            cell = value & 0x0000000F
+            values.append({'index': 2, 'name': definition['name'], 'unit': definition['unit'],
+                           'cell': cell, 'value': round(((value & 0x000FFF00) >> 8) * definition['mult'], 4)})
+            values.append({'index': 2, 'name': definition['name'], 'unit': definition['unit'],
+                           'cell': cell + 1, 'value': round((value >> 20) * definition['mult'], 4)})
+    return values
+
+
+def check_crc(packet):
+    # packet: 0x7E, sensor_id, frame_id, data_id (2), value (4), crc
+    crc = 0
+    for c in range(2, 10):
+        crc += packet[c]
+        crc += crc >> 8
+        crc &= 0x00FF
+    crc = 0xFF - crc
+    if crc == 0:
+        return True
+    return False
+
+
+def encode_frame(sensor_id, data_id, value, frame_id=0x10):
+    # byte stuffed frame with CRC, as sent by a sensor
+    frame = bytearray(FRAME_SIZE)
+    frame[0] = START_BYTE
+    FRAME_STRUCT.pack_into(frame, 1, sensor_id, frame_id, data_id, value & 0xFFFFFFFF)
+    crc = 0
+    for c in range(2, 9):
+        crc += frame[c]
+        crc += crc >> 8
+        crc &= 0x00FF
+    frame[9] = 0xFF - crc
+    packet = bytearray([START_BYTE])
+    for byte in frame[1:]:
+        if byte == START_BYTE or byte == ESCAPE_BYTE:
+            packet.append(ESCAPE_BYTE)
+            packet.append(byte ^ 0x20)
+        else:
+            packet.append(byte)
+    return bytes(packet)
+
+
+class SmartportDecoder():
+
+    # Incremental frame decoder. Bytes are copied into a preallocated buffer
+    # that keeps the pending frame between calls, so escapes and frame
+    # starts split across reads are handled. feed() returns the CRC valid
+    # frames as (sensor_id, frame_id, data_id, value) tuples
+
+    def __init__(self, size=1024):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.frame = bytearray(FRAME_SIZE)
+        self.frame[0] = START_BYTE
+        self.frames = 0
+        self.crc_errors = 0
+        self.resyncs = 0
+
+    def reset(self):
+        self.length = 0
+
+    def feed(self, data):
+        frames = []
+        size = len(data)
+        length = self.length
+        if length + size > len(self.buffer):
+            self.view.release()
+            self.buffer.extend(bytearray(length + size - len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        buffer = self.buffer
+        self.view[length:length + size] = data
+        end = length + size
+        if length:
+            start = 0
+        else:
+            start = buffer.find(START_BYTE, 0, end)
+        while start >= 0:
+            stop = buffer.find(START_BYTE, start + 1, end)
+            complete = self.decode(buffer, start, end if stop < 0 else stop, frames)
+            if stop < 0:
+                if complete:
+                    self.length = 0
+                else:
+                    self.view[0:end - start] = self.view[start:end]
+                    self.length = end - start
+                return frames
+            if not complete and stop - start > 2:
+                # not a bare poll
+                self.resyncs += 1
+            start = stop
+        self.length = 0
+        return frames
+
+    def decode(self, buffer, start, stop, frames):
+        frame = self.frame
+        escape = buffer.find(ESCAPE_BYTE, start + 1, stop)
+        if escape < 0 or escape >= start + FRAME_SIZE:
+            if stop - start < FRAME_SIZE:
+                return False
+            frame[1:FRAME_SIZE] = self.view[start + 1:start + FRAME_SIZE]
+        else:
+            count = 1
+            i = start + 1
+            while count < FRAME_SIZE:
+                if i >= stop:
+                    return False
+                byte = buffer[i]
+                if byte == ESCAPE_BYTE:
+                    if i + 1 >= stop:
+                        return False
+                    byte = buffer[i + 1] ^ 0x20
+                    i += 2
+                else:
+                    i += 1
+                frame[count] = byte
+                count += 1
+        crc = sum(frame[2:FRAME_SIZE])
+        crc = (crc & 0xFF) + (crc >> 8)
+        crc = (crc & 0xFF) + (crc >> 8)
+        if crc == 0xFF:
+            self.frames += 1
+            frames.append(FRAME_STRUCT.unpack_from(frame, 1))
+        else:
+            self.crc_errors += 1
+        return True
@@ -0,0 +1,135 @@
+"""
+           Smartport bulk decoding
+
+ Decodes whole captures with numpy array operations. Results match
+ SmartportDecoder and add_telemetry() for the same bytes
+
+"""
+
+from smartport import get_sensor_data, SmartportDecoder, START_BYTE, ESCAPE_BYTE, FRAME_SIZE
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+COLUMNS = ('timestamp', 'sensor_id', 'data_id', 'slot', 'cell', 'value')
+
+
+def find_frames(data):
+    # returns end offset, sensor_id, frame_id, data_id and value of the CRC
+    # valid frames. The end offset is the position of the last frame byte
+    if np is None:
+        raise ImportError('numpy is required for bulk decoding')
+    raw = np.frombuffer(data, dtype=np.uint8)
+    position = np.arange(raw.size)
+    # in a run of 0x7D every other byte is an escape, starting with the first
+    escape = raw == ESCAPE_BYTE
+    run_start = escape.copy()
+    run_start[1:] &= ~escape[:-1]
+    run_first = np.maximum.accumulate(np.where(run_start, position, 0))
+    marker = escape & ((position - run_first) % 2 == 0)
+    escaped = np.zeros(raw.size, dtype=bool)
+    escaped[1:] = marker[:-1] & (raw[1:] != START_BYTE)
+    keep = ~marker
+    unstuffed = (raw ^ (escaped.astype(np.uint8) << 5))[keep]
+    source = np.flatnonzero(keep)
+    starts = np.flatnonzero((raw == START_BYTE)[keep])
+    available = np.append(starts[1:], unstuffed.size) - starts - 1
+    starts = starts[available >= FRAME_SIZE - 1]
+    frame = unstuffed[starts[:, None] + np.arange(1, FRAME_SIZE)].astype(np.uint32)
+    crc = frame[:, 1:].sum(axis=1)
+    crc = (crc & 0xFF) + (crc >> 8)
+    crc = (crc & 0xFF) + (crc >> 8)
+    valid = crc == 0xFF
+    frame = frame[valid]
+    return {'end': source[starts[valid] + FRAME_SIZE - 1],
+            'sensor_id': frame[:, 0].astype(np.uint8),
+            'frame_id': frame[:, 1].astype(np.uint8),
+            'data_id': (frame[:, 2] | frame[:, 3] << 8).astype(np.uint16),
+            'value': frame[:, 4] | frame[:, 5] << 8 | frame[:, 6] << 16 | frame[:, 7] << 24}
+
+
+def decode_capture(data, offsets=None, times=None):
+    # offsets and times are the start offset and the timestamp of each
+    # received chunk. Returns columnar arrays, one row per sensor value
+    frames = find_frames(data)
+    select = frames['frame_id'] == 0x10
+    data_id = frames['data_id'][select]
+    value = frames['value'][select]
+    end = frames['end'][select]
+    sensor_id = frames['sensor_id'][select]
+    ids, inverse = np.unique(data_id, return_inverse=True)
+    # per data_id tables: multiplier and position of each index in the definition
+    mult = np.zeros((3, ids.size))
+    order = np.full((3, ids.size), -1)
+    for i, id in enumerate(ids.tolist()):
+        sensor_data = get_sensor_data(id)
+        if sensor_data:
+            for position, index in enumerate(sensor_data):
+                mult[index, i] = sensor_data[index]['mult']
+                order[index, i] = position
+    rows = []
+    for index, slot_value, cell, sub in (
+            (0, value & 0x0000FFFF, -1, 0),
+            (1, value >> 16, -1, 0),
+            (2, (value & 0x000FFF00) >> 8, value & 0x0000000F, 0),
+            (2, value >> 20, (value & 0x0000000F) + 1, 1)):
+        mask = order[index][inverse] >= 0
+        rows.append((np.flatnonzero(mask),
+                     order[index][inverse][mask] * 2 + sub,
+                     index,
+                     np.broadcast_to(cell, value.shape)[mask],
+                     slot_value[mask] * mult[index][inverse][mask]))
+    frame = np.concatenate([row[0] for row in rows])
+    sort = np.lexsort((np.concatenate([row[1] for row in rows]), frame))
+    frame = frame[sort]
+    if times is None:
+        timestamp = np.full(frame.size, np.nan)
+    else:
+        chunk = np.searchsorted(np.asarray(offsets), end[frame], side='right') - 1
+        timestamp = np.asarray(times, dtype=np.float64)[chunk]
+    return {'timestamp': timestamp,
+            'sensor_id': sensor_id[frame],
+            'data_id': data_id[frame],
+            'slot': np.concatenate([np.full(row[0].size, row[2], dtype=np.uint8) for row in rows])[sort],
+            'cell': np.concatenate([row[3] for row in rows]).astype(np.int8)[sort],
+            'value': np.concatenate([row[4] for row in rows]).astype(np.float64)[sort]}
+
+
+def decode_stream(chunks, times=None):
+    # reference path: SmartportDecoder fed chunk by chunk, same output as
+    # decode_capture()
+    if np is None:
+        raise ImportError('numpy is required for bulk decoding')
+    decoder = SmartportDecoder()
+    columns = {key: [] for key in COLUMNS}
+    for i, chunk in enumerate(chunks):
+        timestamp = times[i] if times is not None else np.nan
+        for sensor_id, frame_id, data_id, value in decoder.feed(chunk):
+            if frame_id != 0x10:
+                continue
+            sensor_data = get_sensor_data(data_id)
+            if not sensor_data:
+                continue
+            for index in sensor_data:
+                mult = sensor_data[index]['mult']
+                if index == 2:
+                    values = (((value & 0x0000000F), ((value & 0x000FFF00) >> 8) * mult),
+                              ((value & 0x0000000F) + 1, (value >> 20) * mult))
+                elif index == 0:
+                    values = ((-1, (value & 0x0000FFFF) * mult),)
+                else:
+                    values = ((-1, (value >> 16) * mult),)
+                for cell, slot_value in values:
+                    columns['timestamp'].append(timestamp)
+                    columns['sensor_id'].append(sensor_id)
+                    columns['data_id'].append(data_id)
+                    columns['slot'].append(index)
+                    columns['cell'].append(cell)
+                    columns['value'].append(slot_value)
+    return {'timestamp': np.array(columns['timestamp'], dtype=np.float64),
+            'sensor_id': np.array(columns['sensor_id'], dtype=np.uint8),
+            'data_id': np.array(columns['data_id'], dtype=np.uint16),
+            'slot': np.array(columns['slot'], dtype=np.uint8),
+            'cell': np.array(columns['cell'], dtype=np.int8),
+            'value': np.array(columns['value'], dtype=np.float64)}
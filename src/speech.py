@@ -0,0 +1,165 @@
+"""
+           Speech
+
+ Text to speech queue for alarms and periodic value callouts, spoken from
+ its own thread so callers never wait on the speech backend
+
+"""
+
+import heapq
+import logging
+import threading
+import time
+
+CALLOUT = 1
+ALARM = 2
+
+
+def plyer_speak(text):
+    from plyer import tts
+    tts.speak(text)
+
+
+class StubSpeech():
+
+    # Backend that records what would be spoken, for running without a
+    # speech engine
+
+    def __init__(self, duration=0.0):
+        self.duration = duration
+        self.spoken = []
+
+    def __call__(self, text):
+        self.spoken.append((time.monotonic(), text))
+        if self.duration:
+            time.sleep(self.duration)
+
+
+class Announcement():
+
+    __slots__ = ('priority', 'key', 'text', 'expires', 'cancelled')
+
+    def __init__(self, priority, key, text, expires):
+        self.priority = priority
+        self.key = key
+        self.text = text
+        self.expires = expires
+        self.cancelled = False
+
+
+class SpeechQueue():
+
+    # Announcements are spoken highest priority first, then oldest first. A
+    # new announcement replaces a queued one with the same key, one not
+    # spoken within its ttl is dropped and at least gap seconds are left
+    # between two announcements. Callouts are functions returning the text
+    # to speak every interval seconds, or None to skip
+
+    def __init__(self, backend=plyer_speak, ttl=10.0, gap=1.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.gap = gap
+        self.condition = threading.Condition()
+        self.heap = []
+        self.queued = {}
+        self.callouts = {}
+        self.count = 0
+        self.last = 0.0
+        self.spoken = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(name='thread_voice', target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def say(self, text, key=None, priority=ALARM, ttl=None):
+        with self.condition:
+            self.push(text, key, priority, ttl)
+            self.condition.notify()
+
+    def add_callout(self, key, interval, function, priority=CALLOUT):
+        with self.condition:
+            self.callouts[key] = [time.monotonic() + interval, interval, function, priority]
+            self.condition.notify()
+
+    def remove_callout(self, key):
+        with self.condition:
+            self.callouts.pop(key, None)
+
+    def push(self, text, key, priority, ttl):
+        previous = self.queued.get(key) if key is not None else None
+        if previous is not None:
+            previous.cancelled = True
+            self.coalesced += 1
+        announcement = Announcement(priority, key, text, time.monotonic() + (ttl or self.ttl))
+        if key is not None:
+            self.queued[key] = announcement
+        self.count += 1
+        heapq.heappush(self.heap, (-priority, self.count, announcement))
+
+    def pop(self, now):
+        while self.heap:
+            announcement = heapq.heappop(self.heap)[2]
+            if announcement.cancelled:
+                continue
+            if self.queued.get(announcement.key) is announcement:
+                del self.queued[announcement.key]
+            if announcement.expires < now:
+                self.dropped += 1
+                continue
+            return announcement
+        return None
+
+    def schedule(self, now):
+        # queues the due callouts, returns the time of the next one
+        due = None
+        for key, callout in list(self.callouts.items()):
+            when, interval, function, priority = callout
+            if when <= now:
+                text = function()
+                if text:
+                    self.push(text, key, priority, interval)
+                when = callout[0] = now + interval
+            if due is None or when < due:
+                due = when
+        return due
+
+    def next(self):
+        with self.condition:
+            while not self.stopped:
+                now = time.monotonic()
+                due = self.schedule(now)
+                wait = self.last + self.gap - now
+                if wait <= 0:
+                    announcement = self.pop(now)
+                    if announcement is not None:
+                        return announcement
+                    wait = None
+                if due is not None:
+                    wait = due - now if wait is None else min(wait, due - now)
+                self.condition.wait(wait)
+            return None
+
+    def run(self):
+        while True:
+            announcement = self.next()
+            if announcement is None:
+                return
+            try:
+                self.backend(announcement.text)
+            except Exception as error:
+                logging.warning('Speech failed: %s', error)
+            self.last = time.monotonic()
+            self.spoken += 1
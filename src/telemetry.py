@@ -0,0 +1,307 @@
+"""
+           Telemetry
+
+ Latest sensor values decoded from the link
+
+"""
+
+import operator
+import time
+from array import array
+from metrics import metrics
+from series import SeriesBuffer
+from smartport import get_sensor_data
+
+CELLS = 17
+
+SENSOR_FRAMES = metrics.counter_array(
+    'smartport_sensor_frames_total', 'Data frames per physical sensor id', 'sensor_id', 256)
+UNKNOWN_FRAMES = metrics.counter_map(
+    'smartport_unknown_frames_total', 'Data frames with a data_id without definition', 'data_id')
+DECODE_SECONDS = metrics.histogram(
+    'smartport_decode_seconds', 'Decode and store time per received chunk',
+    (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005))
+READ_BYTES = metrics.histogram(
+    'smartport_read_bytes', 'Bytes per received chunk', (1, 8, 32, 64, 128, 256))
+
+
+class CellPack():
+
+    # Cell voltages of a battery sensor. Each cell pair frame updates the
+    # sum, min, max and weakest cell, so reading them is O(1). Cells past
+    # the count reported by the sensor or without a voltage are ignored, a
+    # count of 0 is taken as unknown. stamps holds the time each cell was last received
+
+    __slots__ = ('cells', 'stamps', 'count', 'reporting', 'sum', 'min', 'max', 'weakest')
+
+    def __init__(self):
+        self.cells = array('d', bytes(8 * CELLS))
+        self.stamps = array('d', bytes(8 * CELLS))
+        self.count = 0
+        self.reporting = 0
+        self.sum = 0.0
+        self.min = 0.0
+        self.max = 0.0
+        self.weakest = -1
+
+    @property
+    def delta(self):
+        return self.max - self.min
+
+    def update(self, cell, count, first, second, timestamp):
+        cells = self.cells
+        count = count or CELLS
+        rescan = count != self.count
+        self.count = count
+        for i, volts in ((cell, first), (cell + 1, second)):
+            if i >= count:
+                continue
+            old = cells[i]
+            cells[i] = volts
+            self.stamps[i] = timestamp
+            if rescan or old == volts:
+                continue
+            if old > 0:
+                self.sum -= old
+                self.reporting -= 1
+                if old <= self.min or old >= self.max:
+                    rescan = True
+            if volts > 0:
+                self.sum += volts
+                self.reporting += 1
+                if self.reporting == 1:
+                    self.min = self.max = volts
+                    self.weakest = i
+                elif volts < self.min:
+                    self.min = volts
+                    self.weakest = i
+                elif volts > self.max:
+                    self.max = volts
+        if rescan:
+            self.scan()
+
+    def scan(self):
+        # aggregates from scratch, when the count changes or the min or max
+        # cell rises or drops
+        self.reporting = 0
+        self.sum = 0.0
+        self.min = self.max = 0.0
+        self.weakest = -1
+        cells = self.cells
+        for i in range(self.count):
+            volts = cells[i]
+            if volts <= 0:
+                continue
+            self.sum += volts
+            self.reporting += 1
+            if self.weakest < 0 or volts < self.min:
+                self.min = volts
+                self.weakest = i
+            if volts > self.max:
+                self.max = volts
+
+    def stale(self, timestamp, age):
+        # cells not received for age seconds
+        return [i for i in range(self.count) if timestamp - self.stamps[i] > age]
+
+
+class TelemetrySlot():
+
+    # One value of a sensor. index 0 and 1 hold a number, index 2 a
+    # CellPack. seq is 0 until the first value arrives. watchers are
+    # called with the slot from the reader thread after each update. series
+    # keeps the history when the store has it enabled, for cells a dict of
+    # one series per aggregator shown by a tile, the sum from the start
+
+    __slots__ = ('sensor_id', 'data_id', 'index', 'definition', 'value', 'timestamp', 'seq',
+                 'watchers', 'series')
+
+    def __init__(self, sensor_id, data_id, index, definition):
+        self.sensor_id = sensor_id
+        self.data_id = data_id
+        self.index = index
+        self.definition = definition
+        self.value = CellPack() if index == 2 else 0.0
+        self.timestamp = 0.0
+        self.seq = 0
+        self.watchers = []
+        self.series = None
+
+
+class TelemetryStore():
+
+    # Slots are created once per (sensor_id, data_id, index) and never
+    # removed, so references to them stay valid. Values are written by the
+    # reader thread only, slots are also created by the UI thread when
+    # binding tiles and alarms. history is the capacity of each slot's
+    # series, 0 disables.
+    # logger and publisher get every data frame with its timestamp, the
+    # publisher also with the store's device
+
+    def __init__(self, history=0, device=''):
+        self.slots = {}
+        self.plans = {}
+        self.seq = 0
+        self.history = history
+        self.device = device
+        self.logger = None
+        self.publisher = None
+
+    def clear(self):
+        self.slots.clear()
+        self.plans.clear()
+
+    def slot(self, sensor_id, data_id, index):
+        key = (sensor_id, data_id, index)
+        slot = self.slots.get(key)
+        if slot is None:
+            sensor_data = get_sensor_data(data_id)
+            definition = sensor_data.get(index) if sensor_data else None
+            slot = TelemetrySlot(sensor_id, data_id, index, definition)
+            if self.history and index == 2:
+                slot.series = {'sum': SeriesBuffer(self.history)}
+            elif self.history:
+                slot.series = SeriesBuffer(self.history)
+            # atomic, if both threads create the slot the first one wins
+            slot = self.slots.setdefault(key, slot)
+        return slot
+
+    def series(self, slot, aggregator):
+        # history of a cell slot aggregate, recorded from now on. The dict
+        # is replaced, not changed, as the reader thread iterates it
+        if slot.series is None:
+            return None
+        series = slot.series.get(aggregator)
+        if series is None:
+            series = SeriesBuffer(self.history)
+            slot.series = dict(slot.series, **{aggregator: series})
+        return series
+
+    def get(self, sensor_id, data_id, index):
+        # slot with a value received, None otherwise
+        slot = self.slots.get((sensor_id, data_id, index))
+        if slot is None or slot.seq == 0:
+            return None
+        return slot
+
+    def received(self):
+        return [slot for slot in list(self.slots.values()) if slot.seq]
+
+    def plan(self, sensor_id, data_id):
+        # (index, mult, slot) for each value in the frame
+        sensor_data = get_sensor_data(data_id)
+        plan = ()
+        if sensor_data:
+            plan = tuple((index, sensor_data[index]['mult'], self.slot(sensor_id, data_id, index))
+                         for index in sensor_data)
+        self.plans[sensor_id << 16 | data_id] = plan
+        return plan
+
+    def add(self, frame, timestamp=None):
+        sensor_id, frame_id, data_id, value = frame
+        if frame_id != 0x10:
+            return
+        SENSOR_FRAMES.values[sensor_id] += 1
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if self.logger is not None:
+            self.logger.log(timestamp, frame)
+        if self.publisher is not None:
+            self.publisher.publish(timestamp, frame, self.device)
+        plan = self.plans.get(sensor_id << 16 | data_id)
+        if plan is None:
+            plan = self.plan(sensor_id, data_id)
+        if not plan:
+            UNKNOWN_FRAMES.inc(data_id)
+            return
+        self.seq += 1
+        for index, mult, slot in plan:
+            if index == 0:
+                slot.value = (value & 0x0000FFFF) * mult
+            elif index == 1:
+                slot.value = (value >> 16) * mult
+            else:
+                slot.value.update(value & 0x0000000F, (value & 0x000000F0) >> 4,
+                                  ((value & 0x000FFF00) >> 8) * mult, (value >> 20) * mult, timestamp)
+            slot.timestamp = timestamp
+            slot.seq = self.seq
+            if slot.series is not None:
+                if index == 2:
+                    for aggregator, series in slot.series.items():
+                        series.append(timestamp, AGGREGATORS[aggregator](slot.value))
+                else:
+                    slot.series.append(timestamp, slot.value)
+            if slot.watchers:
+                for watcher in slot.watchers:
+                    watcher(slot)
+
+
+telemetry = TelemetryStore()
+# stores of each device by address, created on first use with the history
+# of the default store. Each connection writes only its own store
+stores = {}
+
+
+def get_store(device):
+    # default store for a tile without device
+    if not device:
+        return telemetry
+    store = stores.get(device)
+    if store is None:
+        store = stores[device] = TelemetryStore(telemetry.history, device)
+    return store
+
+
+def add_telemetry(frame):
+    telemetry.add(frame)
+
+
+def decode_buffer(decoder, buffer, store=telemetry):
+    start = time.perf_counter()
+    for frame in decoder.feed(buffer):
+        store.add(frame)
+    DECODE_SECONDS.observe(time.perf_counter() - start)
+    READ_BYTES.observe(len(buffer))
+
+
+AGGREGATORS = {
+    'sum': operator.attrgetter('sum'),
+    'min': operator.attrgetter('min'),
+    'max': operator.attrgetter('max'),
+    'delta': operator.attrgetter('delta'),
+}
+
+
+class SensorBinding():
+
+    # A monitor tile compiled from its config: the telemetry slot and the
+    # value function, so updates need no config lookups. Without a store
+    # the slot is taken from the store of the tile's device. series is the
+    # history of the value the tile shows
+
+    __slots__ = ('slot', 'read', 'multiplier', 'seen', 'series')
+
+    def __init__(self, sensor, store=None):
+        store = store or get_store(sensor.get('device'))
+        self.slot = store.slot(sensor['sensor_id'], sensor['data_id'], sensor['index'])
+        self.multiplier = sensor['multiplier']
+        if sensor['index'] == 2:
+            self.read = AGGREGATORS[sensor.get('value', 'sum')]
+            self.series = store.series(self.slot, sensor.get('value', 'sum'))
+        else:
+            self.read = None
+            self.series = self.slot.series
+        self.seen = 0
+
+    def changed(self):
+        return self.slot.seq != self.seen
+
+    def value(self):
+        # None until the first value arrives
+        slot = self.slot
+        self.seen = slot.seq
+        if not slot.seq:
+            return None
+        if self.read is None:
+            return round(slot.value * self.multiplier, 2)
+        return round(self.read(slot.value), 2)
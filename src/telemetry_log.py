@@ -0,0 +1,148 @@
+"""
+           Telemetry log
+
+ Every decoded frame written to disk by a background thread. Binary log:
+ header b'SPLOG' + version (1 byte) + start time (double) followed by
+ records of time since start (double), sensor_id (uint8), data_id
+ (uint16) and value (uint32). Csv log: one line per frame with the same
+ fields and the wall clock time
+
+"""
+
+import collections
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'SPLOG'
+VERSION = 1
+HEADER = struct.Struct('<5sBd')
+RECORD = struct.Struct('<dBHI')
+CSV_HEADER = 'timestamp,sensor_id,data_id,value\n'
+EXTENSIONS = {'binary': '.splog', 'csv': '.csv'}
+
+
+class TelemetryLogger():
+
+    # log() is called from the reader thread and only appends to a bounded
+    # deque, frames arriving with the queue full are counted in dropped. The
+    # writer thread drains it every interval, syncs to disk every
+    # sync_interval and starts a new file when one reaches max_size. Frames
+    # are logged with their monotonic timestamp, each file keeps the offset
+    # to its own start
+
+    def __init__(self, prefix, format='binary', queue_size=65536, interval=0.2,
+                 sync_interval=2.0, max_size=16 * 1024 * 1024):
+        self.prefix = prefix
+        self.format = format
+        self.extension = EXTENSIONS[format]
+        self.queue = collections.deque()
+        self.queue_size = queue_size
+        self.interval = interval
+        self.sync_interval = sync_interval
+        self.max_size = max_size
+        self.dropped = 0
+        self.written = 0
+        self.paths = []
+        self.file = None
+        self.origin = 0.0
+        self.event_stop = threading.Event()
+        self.thread = None
+
+    def log(self, timestamp, frame):
+        if len(self.queue) < self.queue_size:
+            self.queue.append((timestamp, frame))
+        else:
+            self.dropped += 1
+
+    def start(self):
+        self.event_stop.clear()
+        self.open()
+        self.thread = threading.Thread(name='thread_log', target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.event_stop.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def open(self):
+        path = '{}-{:03d}{}'.format(self.prefix, len(self.paths), self.extension)
+        self.paths.append(path)
+        start = time.time()
+        if self.format == 'binary':
+            self.origin = time.monotonic()
+            self.file = open(path, 'wb')
+            self.file.write(HEADER.pack(MAGIC, VERSION, start))
+        else:
+            self.origin = time.monotonic() - start
+            self.file = open(path, 'w', newline='')
+            self.file.write(CSV_HEADER)
+        self.size = self.file.tell()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self.file.close()
+        self.file = None
+
+    def write(self, batch):
+        if self.format == 'binary':
+            data = bytearray(RECORD.size * len(batch))
+            offset = 0
+            origin = self.origin
+            for timestamp, (sensor_id, frame_id, data_id, value) in batch:
+                RECORD.pack_into(data, offset, timestamp - origin, sensor_id, data_id, value)
+                offset += RECORD.size
+        else:
+            data = ''.join(['{:.4f},{},{},{}\n'.format(timestamp - self.origin, frame[0], frame[2], frame[3])
+                            for timestamp, frame in batch])
+        self.file.write(data)
+        self.size += len(data)
+        self.written += len(batch)
+        if self.size >= self.max_size:
+            self.close()
+            self.open()
+
+    def drain(self):
+        queue = self.queue
+        while queue:
+            # popleft is atomic, log() may append meanwhile
+            batch = [queue.popleft() for _ in range(min(len(queue), 4096))]
+            self.write(batch)
+
+    def run(self):
+        synced = time.monotonic()
+        while not self.event_stop.wait(self.interval):
+            self.drain()
+            if time.monotonic() - synced >= self.sync_interval:
+                self.sync()
+                synced = time.monotonic()
+        self.drain()
+        self.close()
+
+
+def read_log(path):
+    # yields (timestamp, sensor_id, data_id, value) for each record
+    if path.endswith(EXTENSIONS['csv']):
+        with open(path) as file:
+            if file.readline() != CSV_HEADER:
+                raise ValueError('Not a telemetry log: ' + path)
+            for line in file:
+                fields = line.split(',')
+                if len(fields) == 4:
+                    yield float(fields[0]), int(fields[1]), int(fields[2]), int(fields[3])
+        return
+    with open(path, 'rb') as file:
+        magic, version, start = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a telemetry log: ' + path)
+        data = file.read()
+    # a record cut by a crash is ignored
+    end = len(data) - len(data) % RECORD.size
+    yield from RECORD.iter_unpack(data[:end])